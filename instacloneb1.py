@@ -1,4 +1,6 @@
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template_string, request, redirect, url_for, flash, get_flashed_messages, session, jsonify, g, send_file, abort, Response, stream_with_context
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import sqlite3
@@ -6,107 +8,526 @@ import os
 import base64
 from datetime import datetime
 import uuid
+import threading
+import atexit
+import time
+import math
+from collections import OrderedDict, deque
+import argparse
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+import hashlib
+import io
+import contextlib
+import json
+import bisect
+from array import array
+import re
+import fcntl
+import random
+import tracemalloc
+import secrets
 
-app = Flask(__name__)
-app.secret_key = 'your-secret-key-change-this'
+# Pillow is optional - without it uploads are still deduplicated byte-for-byte,
+# only perceptual hashing is skipped
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
-# Configuration
-UPLOAD_FOLDER = 'uploads'
+# Configuration - every key can be overridden with an INSTACLONE_<KEY> variable
+DEFAULT_CONFIG = {
+    'DATABASE': 'instagram_clone.db',
+    'SECRET_KEY': 'your-secret-key-change-this',
+    'UPLOAD_FOLDER': 'uploads',
+    'RANK_HALF_LIFE_HOURS': 12,
+    'ARCHIVE_FOLDER': 'archive',
+    'ARCHIVE_AFTER_DAYS': 180,
+    'MAINTENANCE_INTERVAL': 3600,
+    'UPLOAD_SESSION_TTL': 86400,
+    'PROFILE_SAMPLE_RATE': 0,
+    'ADMIN_USERNAMES': '',
+    'SESSION_IDLE_TIMEOUT': 14 * 86400,
+}
+CONFIG_ENV_PREFIX = 'INSTACLONE_'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+def load_config_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    return {key: environ.get(CONFIG_ENV_PREFIX + key, default) for key, default in DEFAULT_CONFIG.items()}
+
+app = Flask(__name__)
+app.config.update(load_config_from_env())
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def get_db_connection():
+    # Connections are opened per call, so nothing is shared across a fork.
+    # SQLite leaves foreign keys off unless each connection asks for them
+    conn = sqlite3.connect(app.config['DATABASE'])
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
 # Database initialization
+# Schema changes are numbered migrations tracked in PRAGMA user_version, so
+# startup only touches the schema when a migration is pending.
+def migrate_base_schema(c):
+    # Users table
+    c.execute('''CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        bio TEXT DEFAULT '',
+        unread_notifications INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
+    # Posts table
+    c.execute('''CREATE TABLE posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        image_data TEXT NOT NULL,
+        caption TEXT DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    
+    # Likes table
+    c.execute('''CREATE TABLE likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (post_id) REFERENCES posts (id),
+        UNIQUE(user_id, post_id)
+    )''')
+    
+    # Comments table
+    c.execute('''CREATE TABLE comments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        comment TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (post_id) REFERENCES posts (id)
+    )''')
+    
+    create_notifications_table(c)
+    
+    # Create demo users
+    demo_password = generate_password_hash('demo123')
+    c.execute('INSERT INTO users (username, email, password, bio) VALUES (?, ?, ?, ?)',
+              ('demo_user', 'demo@example.com', demo_password, 'Welcome to my Instagram clone! 📸'))
+    c.execute('INSERT INTO users (username, email, password, bio) VALUES (?, ?, ?, ?)',
+              ('photographer', 'photo@example.com', demo_password, 'Professional photographer 📷 ✨'))
+
+def create_notifications_table(c):
+    # One row per (recipient, post, verb), collapsed on write
+    c.execute('''CREATE TABLE notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        verb TEXT NOT NULL,
+        actor_count INTEGER NOT NULL DEFAULT 1,
+        last_actor_id INTEGER NOT NULL,
+        is_read INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (post_id) REFERENCES posts (id),
+        FOREIGN KEY (last_actor_id) REFERENCES users (id),
+        UNIQUE(user_id, post_id, verb)
+    )''')
+    c.execute('CREATE INDEX idx_notifications_user_updated ON notifications (user_id, updated_at DESC, id DESC)')
+
+# Databases created before migrations existed have the original tables at
+# user_version 0. They are adopted as migration 1 instead of recreated.
+LEGACY_SCHEMA = {
+    'users': {'id', 'username', 'email', 'password', 'bio', 'created_at'},
+    'posts': {'id', 'user_id', 'image_data', 'caption', 'created_at'},
+    'likes': {'id', 'user_id', 'post_id', 'created_at'},
+    'comments': {'id', 'user_id', 'post_id', 'comment', 'created_at'},
+}
+
+def adopt_legacy_schema(c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = {row[0] for row in c.fetchall()}
+    for table, expected in LEGACY_SCHEMA.items():
+        columns = {row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()}
+        if tables != set(LEGACY_SCHEMA) or not expected <= columns:
+            raise RuntimeError(f"{app.config['DATABASE']} has tables but no schema version, and they don't match "
+                               f"the original schema ({sorted(tables)}). Back it up and run `init-db` "
+                               f"to create a fresh database.")
+    c.execute('ALTER TABLE users ADD COLUMN unread_notifications INTEGER DEFAULT 0')
+    create_notifications_table(c)
+
+def migrate_media_blobs(c):
+    # Content-addressed image store shared by all posts, with reference counts
+    c.execute('''CREATE TABLE media_blobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sha256 TEXT UNIQUE NOT NULL,
+        phash TEXT,
+        size_bytes INTEGER NOT NULL,
+        content_type TEXT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute('ALTER TABLE posts ADD COLUMN media_hash TEXT REFERENCES media_blobs (sha256)')
+    c.execute('CREATE INDEX idx_posts_media_hash ON posts (media_hash)')
+    
+    # Move inline base64 images out of existing posts into the blob store
+    c.execute("SELECT id, image_data FROM posts WHERE image_data != ''")
+    for post_id, image_data in c.fetchall():
+        image_bytes = base64.b64decode(image_data)
+        media_hash = hashlib.sha256(image_bytes).hexdigest()
+        write_media_file(media_hash, image_bytes)
+        c.execute('''INSERT INTO media_blobs (sha256, size_bytes, content_type) VALUES (?, ?, ?)
+                     ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1''',
+                  (media_hash, len(image_bytes), sniff_content_type(image_bytes)))
+        c.execute("UPDATE posts SET media_hash = ?, image_data = '' WHERE id = ?", (media_hash, post_id))
+
+def migrate_media_placeholders(c):
+    # Intrinsic size and a tiny inline preview per blob, so the feed can reserve
+    # layout and paint something before the full image arrives
+    c.execute('ALTER TABLE media_blobs ADD COLUMN width INTEGER')
+    c.execute('ALTER TABLE media_blobs ADD COLUMN height INTEGER')
+    c.execute('ALTER TABLE media_blobs ADD COLUMN placeholder TEXT')
+    
+    # Backfill existing blobs (and their perceptual hash) from the stored files
+    c.execute('SELECT sha256 FROM media_blobs')
+    for (media_hash,) in c.fetchall():
+        path = media_path(media_hash)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            info = analyze_image(f.read())
+        c.execute('''UPDATE media_blobs SET phash = COALESCE(phash, ?), width = ?, height = ?, placeholder = ?
+                     WHERE sha256 = ?''',
+                  (info['phash'], info['width'], info['height'], info['placeholder'], media_hash))
+
+def migrate_feed_ranking(c):
+    # Denormalised counters and a decayed engagement score, kept up to date by
+    # toggle_like/add_comment so a feed page is one index range read
+    c.execute('ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0')
+    c.execute('ALTER TABLE posts ADD COLUMN rank_score REAL')
+    c.execute('CREATE INDEX idx_posts_created_at ON posts (created_at DESC)')
+    c.execute('CREATE INDEX idx_posts_rank_score ON posts (rank_score DESC)')
+    
+    c.execute('''UPDATE posts SET
+                 like_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id),
+                 comment_count = (SELECT COUNT(*) FROM comments WHERE post_id = posts.id)''')
+    half_life_hours = float(app.config['RANK_HALF_LIFE_HOURS'])
+    c.execute("""SELECT id, 'post', CAST(strftime('%s', created_at) AS INTEGER) FROM posts
+                 UNION ALL SELECT post_id, 'like', CAST(strftime('%s', created_at) AS INTEGER) FROM likes
+                 UNION ALL SELECT post_id, 'comment', CAST(strftime('%s', created_at) AS INTEGER) FROM comments""")
+    scores = {}
+    for post_id, kind, event_time in c.fetchall():
+        scores[post_id] = rank_add(scores.get(post_id), RANK_WEIGHTS[kind], event_time, half_life_hours)
+    c.executemany('UPDATE posts SET rank_score = ? WHERE id = ?', [(score, post_id) for post_id, score in scores.items()])
+
+def migrate_archive_partitions(c):
+    # Catalog of monthly cold-post archive databases, newest first on read
+    c.execute('''CREATE TABLE archive_partitions (
+        month TEXT PRIMARY KEY,
+        post_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+def migrate_batch_operations(c):
+    # Results of /api/batch operations by client idempotency key, so a
+    # replayed offline queue returns the original outcome instead of re-applying
+    c.execute('''CREATE TABLE batch_operations (
+        user_id INTEGER NOT NULL,
+        idempotency_key TEXT NOT NULL,
+        result TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, idempotency_key),
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+
+def migrate_like_versions(c):
+    # Bumped with every like/unlike so per-process like indexes can tell when
+    # another worker changed a user's likes
+    c.execute('ALTER TABLE users ADD COLUMN like_version INTEGER NOT NULL DEFAULT 0')
+
+def migrate_trending_snapshots(c):
+    # Periodic copies of each process's trending sketches, one row per time bucket
+    c.execute('''CREATE TABLE trending_snapshots (
+        owner TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        sketch BLOB NOT NULL,
+        candidates TEXT NOT NULL,
+        PRIMARY KEY (owner, kind, bucket)
+    )''')
+    c.execute('CREATE INDEX idx_trending_snapshots_kind_bucket ON trending_snapshots (kind, bucket)')
+
+def migrate_upload_sessions(c):
+    # Resumable uploads; the bytes live in UPLOAD_FOLDER/incoming/<id>.part
+    c.execute('''CREATE TABLE upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        caption TEXT DEFAULT '',
+        total_size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        received INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    c.execute('CREATE INDEX idx_upload_sessions_updated_at ON upload_sessions (updated_at)')
+
+def migrate_sessions(c):
+    # Server-side sessions keyed by SHA-256 of the opaque cookie id
+    c.execute('''CREATE TABLE sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        data TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        last_seen REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute('CREATE INDEX idx_sessions_user_id ON sessions (user_id)')
+    c.execute('CREATE INDEX idx_sessions_last_seen ON sessions (last_seen)')
+
+def migrate_soft_deletes(c):
+    # Deleted posts and accounts are tombstoned first and purged in the
+    # background; the indexes keep both the tombstone scans and the cascade
+    # (children by post, activity by user) off full table scans
+    c.execute('ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP')
+    c.execute('ALTER TABLE posts ADD COLUMN deleted_at TIMESTAMP')
+    c.execute('CREATE INDEX idx_users_deleted_at ON users (deleted_at) WHERE deleted_at IS NOT NULL')
+    c.execute('CREATE INDEX idx_posts_deleted_at ON posts (deleted_at) WHERE deleted_at IS NOT NULL')
+    c.execute('CREATE INDEX idx_posts_user_id ON posts (user_id)')
+    c.execute('CREATE INDEX idx_likes_post_id ON likes (post_id)')
+    c.execute('CREATE INDEX idx_comments_post_id ON comments (post_id)')
+    c.execute('CREATE INDEX idx_comments_user_id ON comments (user_id)')
+    c.execute('CREATE INDEX idx_notifications_post_id ON notifications (post_id)')
+    c.execute('CREATE INDEX idx_notifications_last_actor_id ON notifications (last_actor_id)')
+
+def migrate_post_media(c):
+    # The ordered images of a post. Position 0 stays denormalised on
+    # posts.media_hash, so feed queries read covers exactly as before and
+    # media_count tells them which posts get a carousel. Each row holds one
+    # media_blobs reference; a post's existing reference moves to its row 0.
+    c.execute('''CREATE TABLE post_media (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        media_hash TEXT NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        UNIQUE (post_id, position),
+        FOREIGN KEY (post_id) REFERENCES posts (id),
+        FOREIGN KEY (media_hash) REFERENCES media_blobs (sha256)
+    )''')
+    c.execute('CREATE INDEX idx_post_media_media_hash ON post_media (media_hash)')
+    c.execute('ALTER TABLE posts ADD COLUMN media_count INTEGER NOT NULL DEFAULT 1')
+    c.execute('''INSERT INTO post_media (post_id, position, media_hash, width, height)
+                 SELECT p.id, 0, p.media_hash, m.width, m.height
+                 FROM posts p JOIN media_blobs m ON m.sha256 = p.media_hash''')
+
+def migrate_notification_actors(c):
+    # Distinct actors per notification group, so "N others" counts people
+    # rather than events. Existing groups only ever recorded their last actor
+    # and keep their stored counts.
+    c.execute('''CREATE TABLE notification_actors (
+        notification_id INTEGER NOT NULL,
+        actor_id INTEGER NOT NULL,
+        PRIMARY KEY (notification_id, actor_id),
+        FOREIGN KEY (notification_id) REFERENCES notifications (id) ON DELETE CASCADE,
+        FOREIGN KEY (actor_id) REFERENCES users (id)
+    ) WITHOUT ROWID''')
+    c.execute('CREATE INDEX idx_notification_actors_actor_id ON notification_actors (actor_id)')
+    c.execute('INSERT INTO notification_actors (notification_id, actor_id) SELECT id, last_actor_id FROM notifications')
+
+def migrate_feed_keyset_index(c):
+    # Archive partitions carry the same index; they are upgraded here too,
+    # since a finished month is never written (and synced) again
+    conn = c.connection
+    for month in get_archive_months(conn):
+        attach_partition(conn, month)
+        try:
+            if archive_columns(conn, 'posts'):
+                create_feed_index(c, 'archive')
+        finally:
+            conn.execute('DETACH DATABASE archive')
+    create_feed_index(c)
+
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_media_blobs,
+    migrate_media_placeholders,
+    migrate_feed_ranking,
+    migrate_archive_partitions,
+    migrate_batch_operations,
+    migrate_like_versions,
+    migrate_trending_snapshots,
+    migrate_upload_sessions,
+    migrate_sessions,
+    migrate_soft_deletes,
+    migrate_post_media,
+    migrate_notification_actors,
+    migrate_feed_keyset_index,
+]
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrations_pending():
+    conn = get_db_connection()
+    version = get_schema_version(conn)
+    conn.close()
+    return version < len(MIGRATIONS)
+
+def apply_migrations():
+    conn = get_db_connection()
+    c = conn.cursor()
+    # Incremental auto-vacuum has to be chosen before the first table exists
+    # (VACUUM applies it to a file emptied by init_db); older databases are
+    # converted once with the `vacuum` command
+    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    if c.fetchone()[0] == 0 and c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+    # WAL lets readers in every worker process run alongside the writer
+    c.execute('PRAGMA journal_mode=WAL')
+    version = get_schema_version(conn)
+    # sqlite_sequence outlives init_db's DROP TABLEs, so internal tables don't count
+    if version == 0 and c.execute("""SELECT COUNT(*) FROM sqlite_master
+                                     WHERE type = 'table' AND name NOT LIKE 'sqlite_%'""").fetchone()[0]:
+        adopt_legacy_schema(c)
+        version = 1
+        c.execute(f'PRAGMA user_version = {version}')
+        conn.commit()
+        print("✅ Adopted existing database as migration 1")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(c)
+        c.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        print(f"✅ Applied migration {number}: {migration.__name__}")
+    conn.close()
+
 def init_db():
     try:
-        conn = sqlite3.connect('instagram_clone.db')
+        conn = get_db_connection()
+        conn.execute('PRAGMA foreign_keys = OFF')
         c = conn.cursor()
         
         # Drop existing tables if they exist (for clean start)
-        c.execute('DROP TABLE IF EXISTS comments')
-        c.execute('DROP TABLE IF EXISTS likes') 
-        c.execute('DROP TABLE IF EXISTS posts')
-        c.execute('DROP TABLE IF EXISTS users')
-        
-        # Users table
-        c.execute('''CREATE TABLE users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            bio TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        # Posts table
-        c.execute('''CREATE TABLE posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            image_data TEXT NOT NULL,
-            caption TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )''')
-        
-        # Likes table
-        c.execute('''CREATE TABLE likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (post_id) REFERENCES posts (id),
-            UNIQUE(user_id, post_id)
-        )''')
-        
-        # Comments table
-        c.execute('''CREATE TABLE comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            post_id INTEGER NOT NULL,
-            comment TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (post_id) REFERENCES posts (id)
-        )''')
-        
-        # Create demo users
-        demo_password = generate_password_hash('demo123')
-        c.execute('INSERT INTO users (username, email, password, bio) VALUES (?, ?, ?, ?)',
-                  ('demo_user', 'demo@example.com', demo_password, 'Welcome to my Instagram clone! 📸'))
-        c.execute('INSERT INTO users (username, email, password, bio) VALUES (?, ?, ?, ?)',
-                  ('photographer', 'photo@example.com', demo_password, 'Professional photographer 📷 ✨'))
-        
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        for (table,) in c.fetchall():
+            c.execute(f'DROP TABLE IF EXISTS "{table}"')
+        c.execute('PRAGMA user_version = 0')
         conn.commit()
         conn.close()
+        
+        apply_migrations()
         print("✅ Database initialized successfully!")
         
     except Exception as e:
         print(f"❌ Database initialization error: {e}")
-        # Create a simple fallback database
-        try:
-            conn = sqlite3.connect('instagram_clone.db')
-            c = conn.cursor()
-            c.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT, email TEXT, password TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, user_id INTEGER, image_data TEXT, caption TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS likes (id INTEGER PRIMARY KEY, user_id INTEGER, post_id INTEGER)')
-            c.execute('CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY, user_id INTEGER, post_id INTEGER, comment TEXT)')
-            conn.commit()
-            conn.close()
-            print("✅ Fallback database created!")
-        except Exception as fallback_error:
-            print(f"❌ Fallback database error: {fallback_error}")
+
+# Row models
+# Compact __slots__ records built straight from SQLite rows through a cursor
+# row_factory, instead of positional tuples or a dict per row. Each SELECT
+# lists its columns in the same order as the model's __slots__.
+class RowModel:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(*row)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__[:3])
+        return f'{type(self).__name__}({fields}, ...)'
+
+class User(RowModel):
+    __slots__ = ('id', 'username', 'email', 'password', 'bio', 'unread_notifications', 'created_at')
+    id: int
+    username: str
+    email: str
+    password: str
+    bio: str
+    unread_notifications: int
+    created_at: str
+
+class Post(RowModel):
+    __slots__ = ('id', 'image_data', 'caption', 'created_at', 'username', 'like_count', 'comment_count',
+                 'media_hash', 'image_width', 'image_height', 'placeholder', 'media_count', 'partition')
+    id: int
+    image_data: str
+    caption: str
+    created_at: str
+    username: str
+    like_count: int
+    comment_count: int
+    media_hash: str
+    image_width: int
+    image_height: int
+    placeholder: str
+    media_count: int
+    partition: str  # archive month, or None for the hot database
+
+class PostMedia(RowModel):
+    __slots__ = ('position', 'media_hash', 'width', 'height', 'placeholder')
+    position: int
+    media_hash: str
+    width: int
+    height: int
+    placeholder: str
+
+class Comment(RowModel):
+    __slots__ = ('comment', 'created_at', 'username')
+    comment: str
+    created_at: str
+    username: str
+
+class Notification(RowModel):
+    __slots__ = ('id', 'post_id', 'verb', 'actor_count', 'last_actor', 'is_read', 'updated_at')
+    id: int
+    post_id: int
+    verb: str
+    actor_count: int
+    last_actor: str
+    is_read: int
+    updated_at: str
+
+class UploadSession(RowModel):
+    __slots__ = ('id', 'user_id', 'filename', 'caption', 'total_size', 'sha256', 'received', 'updated_at')
+    id: str
+    user_id: int
+    filename: str
+    caption: str
+    total_size: int
+    sha256: str
+    received: int
+    updated_at: str
 
 # Database helper functions with error handling
 def get_user_by_username(username):
     try:
-        conn = sqlite3.connect('instagram_clone.db')
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE username = ?', (username,))
+        c.row_factory = User.row_factory
+        c.execute('''SELECT id, username, email, password, bio, unread_notifications, created_at
+                     FROM users WHERE username = ? AND deleted_at IS NULL''', (username,))
         user = c.fetchone()
         conn.close()
         return user
@@ -116,7 +537,7 @@ def get_user_by_username(username):
 
 def create_user(username, email, password):
     try:
-        conn = sqlite3.connect('instagram_clone.db')
+        conn = get_db_connection()
         c = conn.cursor()
         hashed_password = generate_password_hash(password)
         c.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
@@ -128,96 +549,2368 @@ def create_user(username, email, password):
         print(f"Error creating user: {e}")
         return False
 
-def get_posts_for_feed(limit=20):
-    conn = sqlite3.connect('instagram_clone.db')
+FEED_POST_COLUMNS = ('p.id', 'p.image_data', 'p.caption', 'p.created_at', 'u.username', 'p.like_count',
+                     'p.comment_count', 'p.media_hash', 'm.width', 'm.height', 'm.placeholder', 'p.media_count')
+
+FEED_PAGE_SIZE = 20
+
+def get_posts_for_feed(limit=20, ordering='recent', before=None):
+    # before is a (created_at, id) keyset cursor for the chronological feed
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''SELECT p.id, p.image_data, p.caption, p.created_at, u.username,
-                        (SELECT COUNT(*) FROM likes WHERE post_id = p.id) as like_count,
-                        (SELECT COUNT(*) FROM comments WHERE post_id = p.id) as comment_count
-                 FROM posts p
-                 JOIN users u ON p.user_id = u.id
-                 ORDER BY p.created_at DESC
-                 LIMIT ?''', (limit,))
+    c.row_factory = Post.row_factory
+    where, params = 'WHERE p.deleted_at IS NULL AND u.deleted_at IS NULL', []
+    if before is not None and ordering == 'recent':
+        where, params = where + ' AND (p.created_at, p.id) < (?, ?)', list(before)
+    c.execute(f'''SELECT {', '.join(FEED_POST_COLUMNS)}, NULL
+                  FROM posts p
+                  JOIN users u ON p.user_id = u.id
+                  LEFT JOIN media_blobs m ON m.sha256 = p.media_hash
+                  {where}
+                  ORDER BY {FEED_ORDERINGS[ordering]}
+                  LIMIT ?''', params + [limit])
     posts = c.fetchall()
+    
+    # Only a chronological page that runs off the end of the hot database
+    # reaches into the archives, newest month first
+    if ordering == 'recent' and len(posts) < limit:
+        posts.extend(get_archived_posts(conn, limit - len(posts), before))
     conn.close()
     return posts
 
-def create_post(user_id, image_data, caption):
+def create_post(user_id, images, caption):
+    # images is the ordered list of file contents; the first is the cover
     try:
-        conn = sqlite3.connect('instagram_clone.db')
+        images = images[:CAROUSEL_MAX_ITEMS]
+        hashes = map_media(media_digest, images)
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute('INSERT INTO posts (user_id, image_data, caption) VALUES (?, ?, ?)',
-                  (user_id, image_data, caption))
+        
+        # Only decode an image (hash, size, placeholder) when its blob is new;
+        # the decoding and file writes happen before the write transaction
+        c.execute(f"SELECT sha256 FROM media_blobs WHERE sha256 IN ({','.join('?' * len(hashes))})", hashes)
+        known = {row[0] for row in c.fetchall()}
+        new = {media_hash: image_bytes for media_hash, image_bytes in zip(hashes, images) if media_hash not in known}
+        infos = dict(zip(new, map_media(prepare_media, new, new.values())))
+        
+        for media_hash, image_bytes in zip(hashes, images):
+            store_media_blob(c, media_hash, image_bytes, infos.pop(media_hash, None))
+        now = int(time.time())  # the stored created_at, as compute_post_score reads it
+        rank_score = rank_add(None, RANK_WEIGHTS['post'], now, float(app.config['RANK_HALF_LIFE_HOURS']))
+        c.execute("""INSERT INTO posts (user_id, image_data, caption, media_hash, media_count, rank_score, created_at)
+                     VALUES (?, '', ?, ?, ?, ?, datetime(?, 'unixepoch'))""",
+                  (user_id, caption, hashes[0], len(hashes), rank_score, now))
+        post_id = c.lastrowid
+        c.executemany('''INSERT INTO post_media (post_id, position, media_hash, width, height)
+                         SELECT ?, ?, sha256, width, height FROM media_blobs WHERE sha256 = ?''',
+                      [(post_id, position, media_hash) for position, media_hash in enumerate(hashes)])
         conn.commit()
         conn.close()
+        trending.record('post', post_id, caption)
         return True
     except Exception as e:
         print(f"Error creating post: {e}")
         return False
 
+def set_like(c, user_id, post_id, liked):
+    # Set-style like/unlike inside the caller's transaction. Returns True when
+    # the like state changed, False when it already matched, and None when the
+    # post is missing, deleted or archived (archived posts are read-only)
+    c.execute("SELECT CAST(strftime('%s', created_at) AS INTEGER) FROM likes WHERE user_id = ? AND post_id = ?",
+              (user_id, post_id))
+    existing_like = c.fetchone()
+    if liked == (existing_like is not None):
+        return False
+    
+    if liked:
+        c.execute('UPDATE posts SET like_count = like_count + 1 WHERE id = ? AND deleted_at IS NULL', (post_id,))
+        if c.rowcount == 0:
+            return None
+        # The score uses the stored whole-second created_at, which is what a
+        # later unlike subtracts, so a like/unlike pair leaves no residue
+        now = int(time.time())
+        c.execute("INSERT INTO likes (user_id, post_id, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+                  (user_id, post_id, now))
+        update_post_score(c, post_id, 'like', now)
+    else:
+        c.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
+        c.execute('UPDATE posts SET like_count = like_count - 1 WHERE id = ?', (post_id,))
+        update_post_score(c, post_id, 'like', existing_like[0], remove=True)
+    c.execute('UPDATE users SET like_version = like_version + 1 WHERE id = ?', (user_id,))
+    return True
+
+def insert_comment(c, user_id, post_id, comment):
+    # Runs inside the caller's transaction; False when the post is missing, deleted or archived
+    c.execute('UPDATE posts SET comment_count = comment_count + 1 WHERE id = ? AND deleted_at IS NULL', (post_id,))
+    if c.rowcount == 0:
+        return False
+    now = int(time.time())  # matches the stored created_at, as for likes
+    c.execute("INSERT INTO comments (user_id, post_id, comment, created_at) VALUES (?, ?, ?, datetime(?, 'unixepoch'))",
+              (user_id, post_id, comment, now))
+    update_post_score(c, post_id, 'comment', now)
+    return True
+
 def toggle_like(user_id, post_id):
     try:
-        conn = sqlite3.connect('instagram_clone.db')
+        conn = get_db_connection()
         c = conn.cursor()
         
         # Check if already liked
-        c.execute('SELECT id FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-        existing_like = c.fetchone()
-        
-        if existing_like:
-            c.execute('DELETE FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-            liked = False
-        else:
-            c.execute('INSERT INTO likes (user_id, post_id) VALUES (?, ?)', (user_id, post_id))
-            liked = True
+        c.execute('SELECT 1 FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
+        liked = c.fetchone() is None
+        if set_like(c, user_id, post_id, liked) is None:
+            conn.close()
+            return False
         
         conn.commit()
         conn.close()
+        like_index.record(user_id, post_id, liked)
+        if liked:
+            notification_buffer.add('like', user_id, post_id)
+            trending.record('like', post_id)
         return liked
     except Exception as e:
         print(f"Error toggling like: {e}")
         return False
 
-def add_comment(user_id, post_id, comment):
-    try:
-        conn = sqlite3.connect('instagram_clone.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO comments (user_id, post_id, comment) VALUES (?, ?, ?)',
-                  (user_id, post_id, comment))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Error adding comment: {e}")
-        return False
+def add_comment(user_id, post_id, comment):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        if not insert_comment(c, user_id, post_id, comment):
+            conn.close()
+            return False
+        conn.commit()
+        conn.close()
+        notification_buffer.add('comment', user_id, post_id)
+        trending.record('comment', post_id, comment)
+        return True
+    except Exception as e:
+        print(f"Error adding comment: {e}")
+        return False
+
+# Batched mutations for offline clients
+# A reconnecting client sends its queued likes, unlikes and comments in one
+# request. They are applied in order in a single transaction; like/unlike set
+# the state rather than toggling it, and each operation's result is stored
+# under the client's idempotency key so a retried batch is answered from the
+# stored results instead of being applied twice.
+BATCH_MAX_OPERATIONS = 100
+BATCH_KEY_MAX_LENGTH = 128
+BATCH_KEY_TTL_DAYS = 7
+BATCH_OPERATIONS = ('like', 'unlike', 'comment')
+
+def apply_batch_operation(c, user_id, operation):
+    # Returns (result, notification event or None)
+    op, post_id = operation.get('op'), operation.get('post_id')
+    result = {'key': operation.get('key'), 'op': op, 'post_id': post_id}
+    if op not in BATCH_OPERATIONS or not isinstance(post_id, int) or isinstance(post_id, bool):
+        result.update(status='error', error='Invalid operation')
+        return result, None
+    
+    event = None
+    if op == 'comment':
+        comment = operation.get('comment')
+        comment = comment.strip() if isinstance(comment, str) else ''
+        if not comment:
+            result.update(status='error', error='Invalid comment')
+            return result, None
+        if insert_comment(c, user_id, post_id, comment):
+            event = ('comment', post_id, comment)
+    else:
+        result['liked'] = op == 'like'
+        if set_like(c, user_id, post_id, result['liked']) and op == 'like':
+            event = ('like', post_id, '')
+    
+    c.execute('SELECT like_count, comment_count FROM posts WHERE id = ? AND deleted_at IS NULL', (post_id,))
+    counts = c.fetchone()
+    if counts is None:
+        result.pop('liked', None)
+        result.update(status='error', error='Post not found')
+        return result, None
+    result.update(status='ok', like_count=counts[0], comment_count=counts[1])
+    return result, event
+
+def apply_batch(user_id, operations):
+    conn = get_db_connection()
+    c = conn.cursor()
+    results, events, like_changes = [], [], []
+    try:
+        # Take the write lock up front rather than upgrading mid-batch
+        c.execute('BEGIN IMMEDIATE')
+        c.execute("DELETE FROM batch_operations WHERE user_id = ? AND created_at < datetime('now', ?)",
+                  (user_id, f'-{BATCH_KEY_TTL_DAYS} days'))
+        for operation in operations:
+            key = operation.get('key')
+            if key is not None:
+                c.execute('SELECT result FROM batch_operations WHERE user_id = ? AND idempotency_key = ?',
+                          (user_id, key))
+                stored = c.fetchone()
+                if stored:
+                    result = json.loads(stored[0])
+                    result['replayed'] = True
+                    results.append(result)
+                    continue
+            
+            result, event = apply_batch_operation(c, user_id, operation)
+            if result['status'] == 'ok' and 'liked' in result:
+                like_changes.append((result['post_id'], result['liked']))
+            if key is not None:
+                c.execute('INSERT INTO batch_operations (user_id, idempotency_key, result) VALUES (?, ?, ?)',
+                          (user_id, key, json.dumps(result)))
+            results.append(result)
+            if event:
+                events.append(event)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    # Unchanged likes didn't bump like_version; the index drops such entries
+    # and reloads them on the next check
+    for post_id, liked in like_changes:
+        like_index.record(user_id, post_id, liked)
+    for verb, post_id, text in events:
+        notification_buffer.add(verb, user_id, post_id)
+        trending.record(verb, post_id, text)
+    return results
+
+def get_comments(post_id, limit=-1, partition=None):
+    try:
+        conn = get_db_connection()
+        schema = attach_partition(conn, partition) if partition else 'main'
+        c = conn.cursor()
+        c.row_factory = Comment.row_factory
+        c.execute(f'''SELECT c.comment, c.created_at, u.username 
+                      FROM {schema}.comments c
+                      JOIN main.users u ON c.user_id = u.id
+                      WHERE c.post_id = ? AND u.deleted_at IS NULL
+                      ORDER BY c.created_at ASC
+                      LIMIT ?''', (post_id, limit))
+        comments = c.fetchall()
+        conn.close()
+        return comments
+    except Exception as e:
+        print(f"Error getting comments: {e}")
+        return []
+
+def is_liked_by_user(user_id, post_id, partition=None):
+    try:
+        conn = get_db_connection()
+        schema = attach_partition(conn, partition) if partition else 'main'
+        c = conn.cursor()
+        c.execute(f'SELECT id FROM {schema}.likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
+        result = c.fetchone()
+        conn.close()
+        return result is not None
+    except Exception as e:
+        print(f"Error checking like status: {e}")
+        return False
+
+def get_post_media(post_id, partition=None):
+    # All images of a post in order; the feed only renders the cover, so this
+    # runs when a viewer first steps through a carousel
+    try:
+        conn = get_db_connection()
+        if partition and partition not in get_archive_months(conn):
+            conn.close()
+            return []
+        schema = attach_partition(conn, partition) if partition else 'main'
+        c = conn.cursor()
+        c.row_factory = PostMedia.row_factory
+        c.execute(f'''SELECT pm.position, pm.media_hash, pm.width, pm.height, m.placeholder
+                      FROM {schema}.post_media pm
+                      JOIN {schema}.posts p ON pm.post_id = p.id
+                      JOIN main.users u ON p.user_id = u.id
+                      LEFT JOIN main.media_blobs m ON m.sha256 = pm.media_hash
+                      WHERE pm.post_id = ? AND u.deleted_at IS NULL {'AND p.deleted_at IS NULL' if schema == 'main' else ''}
+                      ORDER BY pm.position''', (post_id,))
+        media = c.fetchall()
+        conn.close()
+        return media
+    except Exception as e:
+        print(f"Error getting post media: {e}")
+        return []
+
+# Like membership index
+# Each process keeps, per recently active viewer, the post ids they liked as a
+# sorted 64-bit array, so "which of these posts did I like" for a whole feed
+# page is one like_version read plus a binary search per post. Only the newest
+# LIKE_INDEX_MAX_LIKES likes are kept: every liked post id >= floor is in the
+# array, and the rare older post is checked in SQLite. Viewers are evicted
+# least recently used first.
+LIKE_INDEX_MAX_USERS = 2048
+LIKE_INDEX_MAX_LIKES = 4096  # per user; 8 bytes each
+
+class LikeIndex:
+    def __init__(self, max_users=LIKE_INDEX_MAX_USERS, max_likes=LIKE_INDEX_MAX_LIKES):
+        self.max_users = max_users
+        self.max_likes = max_likes
+        self._users = OrderedDict()  # user_id -> [like_version, floor, array of post ids]
+        self._lock = threading.Lock()
+
+    def _load(self, c, user_id, version):
+        c.execute('SELECT post_id FROM likes WHERE user_id = ? ORDER BY post_id DESC LIMIT ?',
+                  (user_id, self.max_likes + 1))
+        post_ids = [row[0] for row in c.fetchall()]
+        floor = 0
+        if len(post_ids) > self.max_likes:
+            floor = post_ids[self.max_likes - 1]
+            del post_ids[self.max_likes:]
+        post_ids.reverse()
+        entry = [version, floor, array('q', post_ids)]
+        with self._lock:
+            self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entry
+
+    def liked_posts(self, user_id, post_ids):
+        # Returns the subset of post_ids the user has liked
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT like_version FROM users WHERE id = ?', (user_id,))
+        row = c.fetchone()
+        if row is None:
+            conn.close()
+            return set()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] == row[0]:
+                self._users.move_to_end(user_id)
+            else:
+                entry = None
+        if entry is None:
+            entry = self._load(c, user_id, row[0])
+        
+        _, floor, liked_ids = entry
+        liked, older = set(), []
+        for post_id in post_ids:
+            if post_id < floor:
+                older.append(post_id)
+                continue
+            i = bisect.bisect_left(liked_ids, post_id)
+            if i < len(liked_ids) and liked_ids[i] == post_id:
+                liked.add(post_id)
+        if older:
+            c.execute(f'''SELECT post_id FROM likes
+                          WHERE user_id = ? AND post_id IN ({','.join('?' * len(older))})''', [user_id] + older)
+            liked.update(row[0] for row in c.fetchall())
+        conn.close()
+        return liked
+
+    def record(self, user_id, post_id, liked):
+        # Mirrors a committed like/unlike (which bumped like_version by one).
+        # If another process changed the user's likes too, the versions no
+        # longer line up and the next check reloads from SQLite.
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            version, floor, liked_ids = entry
+            if post_id >= floor:
+                i = bisect.bisect_left(liked_ids, post_id)
+                present = i < len(liked_ids) and liked_ids[i] == post_id
+                if present == liked:
+                    # Nothing changed, so like_version wasn't bumped either
+                    del self._users[user_id]
+                    return
+                if liked:
+                    liked_ids.insert(i, post_id)
+                    if len(liked_ids) > self.max_likes:
+                        entry[1] = liked_ids.pop(0) + 1
+                else:
+                    del liked_ids[i]
+            entry[0] = version + 1
+
+    def __len__(self):
+        return len(self._users)
+
+like_index = LikeIndex()
+
+# Cold-post archive
+# Posts older than ARCHIVE_AFTER_DAYS move, with their likes and comments, into
+# one SQLite file per month under ARCHIVE_FOLDER. Archives are ATTACHed only
+# when a chronological page runs past the hot database, so old rows no longer
+# bloat the hot indexes, VACUUM or backups. Archived posts are read-only.
+ARCHIVE_TABLES = ('posts', 'post_media', 'likes', 'comments')
+ARCHIVE_BATCH_SIZE = 200    # posts moved per transaction
+ARCHIVE_BATCH_PAUSE = 0.05  # seconds between batches, to let writers in
+
+def archive_path(month):
+    return os.path.join(app.config['ARCHIVE_FOLDER'], f'posts_{month}.db')
+
+def attach_partition(conn, month, schema='archive'):
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(month),))
+    return schema
+
+def archive_columns(conn, table, schema='archive'):
+    # Empty when the partition predates the table
+    return {row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})').fetchall()}
+
+def get_archive_months(conn, before=None):
+    c = conn.cursor()
+    if before is None:
+        c.execute('SELECT month FROM archive_partitions WHERE post_count > 0 ORDER BY month DESC')
+    else:
+        c.execute('''SELECT month FROM archive_partitions
+                     WHERE post_count > 0 AND month <= strftime('%Y_%m', ?) ORDER BY month DESC''', (before[0],))
+    return [row[0] for row in c.fetchall()]
+
+def get_archived_posts(conn, limit, before=None):
+    posts = []
+    c = conn.cursor()
+    c.row_factory = Post.row_factory
+    for month in get_archive_months(conn, before):
+        attach_partition(conn, month)
+        try:
+            where, params = 'WHERE u.deleted_at IS NULL', []
+            if before is not None:
+                where, params = where + ' AND (p.created_at, p.id) < (?, ?)', list(before)
+            columns = FEED_POST_COLUMNS
+            if 'media_count' not in archive_columns(conn, 'posts'):
+                columns = columns[:-1] + ('1',)  # archived before carousels existed
+            c.execute(f'''SELECT {', '.join(columns)}, ?
+                          FROM archive.posts p
+                          JOIN main.users u ON p.user_id = u.id
+                          LEFT JOIN main.media_blobs m ON m.sha256 = p.media_hash
+                          {where}
+                          ORDER BY p.created_at DESC, p.id DESC
+                          LIMIT ?''', [month] + params + [limit - len(posts)])
+            posts.extend(c.fetchall())
+        finally:
+            conn.execute('DETACH DATABASE archive')
+        if len(posts) >= limit:
+            break
+    return posts
+
+def create_feed_index(c, schema='main'):
+    # Matches the keyset ORDER BY (created_at DESC, id DESC), so a feed page is
+    # an index range read with no sort step; replaces the created_at-only index
+    c.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_posts_created_at_id ON posts (created_at DESC, id DESC)')
+    c.execute(f'DROP INDEX IF EXISTS {schema}.idx_posts_created_at')
+
+def sync_archive_table(c, table):
+    # Archive tables mirror the hot columns without constraints (users live
+    # only in the hot database); new hot columns are added as they appear
+    hot_columns = [row[1] for row in c.execute(f'PRAGMA main.table_info({table})').fetchall()]
+    archive_columns = {row[1] for row in c.execute(f'PRAGMA archive.table_info({table})').fetchall()}
+    if not archive_columns:
+        c.execute(f'CREATE TABLE archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+        c.execute(f'CREATE UNIQUE INDEX archive.idx_{table}_id ON {table} (id)')
+        if table == 'posts':
+            create_feed_index(c, 'archive')
+        else:
+            c.execute(f'CREATE INDEX archive.idx_{table}_post_id ON {table} (post_id)')
+    else:
+        for column in hot_columns:
+            if column not in archive_columns:
+                c.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column}')
+    return hot_columns
+
+def archive_posts_batch(after_days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    # Moves up to batch_size of the oldest eligible posts; returns how many.
+    # Copies are INSERT OR REPLACE, so if a crash lands between the archive
+    # and hot commits the next batch simply finishes the move.
+    if after_days is None:
+        after_days = float(app.config['ARCHIVE_AFTER_DAYS'])
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id, strftime('%Y_%m', created_at) FROM posts
+                 WHERE created_at < datetime('now', ?) AND deleted_at IS NULL ORDER BY created_at LIMIT ?""",
+              (f'-{after_days} days', batch_size))
+    by_month = {}
+    for post_id, month in c.fetchall():
+        by_month.setdefault(month, []).append(post_id)
+    
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+    moved = 0
+    for month, post_ids in by_month.items():
+        attach_partition(conn, month)
+        try:
+            columns = {table: sync_archive_table(c, table) for table in ARCHIVE_TABLES}
+            placeholders = ','.join('?' * len(post_ids))
+            for table in ARCHIVE_TABLES:
+                key = 'id' if table == 'posts' else 'post_id'
+                column_list = ', '.join(columns[table])
+                c.execute(f'''INSERT OR REPLACE INTO archive.{table} ({column_list})
+                              SELECT {column_list} FROM main.{table} WHERE {key} IN ({placeholders})''', post_ids)
+            # Notifications about archived posts are dropped, not archived
+            delete_notifications(c, f'post_id IN ({placeholders})', post_ids)
+            for table in ('likes', 'comments', 'post_media', 'posts'):
+                key = 'id' if table == 'posts' else 'post_id'
+                c.execute(f'DELETE FROM main.{table} WHERE {key} IN ({placeholders})', post_ids)
+            c.execute('''INSERT INTO archive_partitions (month, post_count) VALUES (?, ?)
+                         ON CONFLICT(month) DO UPDATE SET post_count = post_count + excluded.post_count,
+                         updated_at = CURRENT_TIMESTAMP''', (month, len(post_ids)))
+            conn.commit()
+            moved += len(post_ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE archive')
+    conn.close()
+    return moved
+
+def archive_old_posts(after_days=None, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE):
+    # Online: many short transactions instead of one long write lock
+    total = 0
+    while True:
+        try:
+            moved = archive_posts_batch(after_days, batch_size)
+        except Exception as e:
+            print(f"Error archiving posts: {e}")
+            break
+        total += moved
+        if moved < batch_size:
+            break
+        time.sleep(pause)
+    return total
+
+# Deletion and garbage collection
+# Deleting a post or an account only sets deleted_at, which every read path
+# filters on, so it takes effect at once and costs one row write. The rest
+# happens in the maintenance process in short transactions:
+#   1. posts of deleted accounts are tombstoned,
+#   2. a deleted account's likes and comments on other posts are removed,
+#      keeping like/comment counters and rank scores right,
+#   3. tombstoned posts lose their notifications, likes and comments, then
+#      the post row and its media reference go,
+#   4. accounts with nothing left are removed (with their archived posts).
+# Media files are then reclaimed by mark-and-sweep: hashes referenced by any
+# hot or archived post are marked, unmarked blob rows and files past a grace
+# period are swept. Freed pages go back to the filesystem through incremental
+# vacuum, a bounded number of pages per step.
+CLEANUP_BATCH_SIZE = 500        # child rows per transaction
+CLEANUP_POSTS_PER_BATCH = 50
+CLEANUP_BATCH_PAUSE = 0.05      # seconds between batches, to let writers in
+MEDIA_GC_GRACE_SECONDS = 3600   # never sweep anything touched this recently
+VACUUM_PAGES_PER_STEP = 1000
+
+def delete_post(user_id, post_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('UPDATE posts SET deleted_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ? AND deleted_at IS NULL',
+                  (post_id, user_id))
+        deleted = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return deleted
+    except Exception as e:
+        print(f"Error deleting post: {e}")
+        return False
+
+def delete_account(user_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = ? AND deleted_at IS NULL', (user_id,))
+        deleted = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        if deleted:
+            session_store.revoke_user(user_id)
+        return deleted
+    except Exception as e:
+        print(f"Error deleting account: {e}")
+        return False
+
+def run_batches(step, pause=CLEANUP_BATCH_PAUSE):
+    # Calls step() - one short transaction returning how much it did - until
+    # there is nothing left
+    total = 0
+    while True:
+        done = step()
+        if not done:
+            return total
+        total += done
+        time.sleep(pause)
+
+def tombstone_deleted_users_posts():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''UPDATE posts SET deleted_at = CURRENT_TIMESTAMP WHERE id IN (
+                     SELECT p.id FROM users u JOIN posts p ON p.user_id = u.id
+                     WHERE u.deleted_at IS NOT NULL AND p.deleted_at IS NULL LIMIT ?)''', (CLEANUP_BATCH_SIZE,))
+    done = c.rowcount
+    conn.commit()
+    conn.close()
+    return done
+
+def purge_deleted_users_activity():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('SELECT id FROM users WHERE deleted_at IS NOT NULL')
+    user_ids = [row[0] for row in c.fetchall()]
+    done = 0
+    for user_id in user_ids:
+        c.execute('SELECT post_id FROM likes WHERE user_id = ? LIMIT ?', (user_id, CLEANUP_BATCH_SIZE))
+        for (post_id,) in c.fetchall():
+            set_like(c, user_id, post_id, False)
+            done += 1
+        c.execute("""SELECT id, post_id, CAST(strftime('%s', created_at) AS INTEGER) FROM comments
+                     WHERE user_id = ? LIMIT ?""", (user_id, CLEANUP_BATCH_SIZE))
+        for comment_id, post_id, created_at in c.fetchall():
+            c.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
+            c.execute('UPDATE posts SET comment_count = comment_count - 1 WHERE id = ?', (post_id,))
+            update_post_score(c, post_id, 'comment', created_at, remove=True)
+            done += 1
+        if done:
+            break
+    conn.commit()
+    conn.close()
+    return done
+
+def purge_deleted_posts():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('SELECT id FROM posts WHERE deleted_at IS NOT NULL LIMIT ?', (CLEANUP_POSTS_PER_BATCH,))
+    post_ids = [row[0] for row in c.fetchall()]
+    if not post_ids:
+        conn.close()
+        return 0
+    placeholders = ','.join('?' * len(post_ids))
+    
+    # Children first, a bounded slice at a time - a viral post can have many
+    for table in ('notifications', 'likes', 'comments'):
+        where = f'id IN (SELECT id FROM {table} WHERE post_id IN ({placeholders}) LIMIT ?)'
+        if table == 'notifications':
+            done = delete_notifications(c, where, post_ids + [CLEANUP_BATCH_SIZE])
+        else:
+            c.execute(f'DELETE FROM {table} WHERE {where}', post_ids + [CLEANUP_BATCH_SIZE])
+            done = c.rowcount
+        if done:
+            conn.commit()
+            conn.close()
+            return done
+    
+    # Media references are held by post_media rows, at most CAROUSEL_MAX_ITEMS a post
+    c.execute(f'DELETE FROM post_media WHERE post_id IN ({placeholders}) RETURNING media_hash', post_ids)
+    released = c.fetchall()
+    c.execute(f'DELETE FROM posts WHERE id IN ({placeholders})', post_ids)
+    c.executemany('UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = ?', released)
+    conn.commit()
+    conn.close()
+    return len(post_ids)
+
+def purge_archived_posts(conn, user_id):
+    # Archives are otherwise read-only; an account's archived posts and its
+    # activity there go with it (counters on other archived posts are frozen)
+    for month in get_archive_months(conn):
+        attach_partition(conn, month)
+        try:
+            c = conn.cursor()
+            for table in ('likes', 'comments'):
+                c.execute(f'''DELETE FROM archive.{table} WHERE user_id = ?
+                              OR post_id IN (SELECT id FROM archive.posts WHERE user_id = ?)''', (user_id, user_id))
+            
+            # Archived posts keep their media references, held by post_media
+            # rows - or, for posts archived before carousels, by the post itself
+            if archive_columns(conn, 'post_media'):
+                c.execute('''SELECT media_hash, COUNT(*) FROM (
+                                 SELECT pm.media_hash FROM archive.post_media pm
+                                 JOIN archive.posts p ON p.id = pm.post_id WHERE p.user_id = ?
+                                 UNION ALL
+                                 SELECT p.media_hash FROM archive.posts p
+                                 WHERE p.user_id = ? AND p.media_hash IS NOT NULL
+                                 AND NOT EXISTS (SELECT 1 FROM archive.post_media WHERE post_id = p.id))
+                             GROUP BY media_hash''', (user_id, user_id))
+            else:
+                c.execute('''SELECT media_hash, COUNT(*) FROM archive.posts
+                             WHERE user_id = ? AND media_hash IS NOT NULL GROUP BY media_hash''', (user_id,))
+            released = [(count, media_hash) for media_hash, count in c.fetchall()]
+            if archive_columns(conn, 'post_media'):
+                c.execute('''DELETE FROM archive.post_media
+                             WHERE post_id IN (SELECT id FROM archive.posts WHERE user_id = ?)''', (user_id,))
+            c.executemany('UPDATE main.media_blobs SET ref_count = ref_count - ? WHERE sha256 = ?', released)
+            c.execute('DELETE FROM archive.posts WHERE user_id = ?', (user_id,))
+            c.execute('UPDATE archive_partitions SET post_count = post_count - ? WHERE month = ?', (c.rowcount, month))
+            conn.commit()
+        finally:
+            conn.execute('DETACH DATABASE archive')
+
+def purge_deleted_users():
+    # Removes deleted accounts whose posts, likes and comments are all gone
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''SELECT id FROM users u WHERE deleted_at IS NOT NULL
+                 AND NOT EXISTS (SELECT 1 FROM posts WHERE user_id = u.id)
+                 AND NOT EXISTS (SELECT 1 FROM likes WHERE user_id = u.id)
+                 AND NOT EXISTS (SELECT 1 FROM comments WHERE user_id = u.id)
+                 LIMIT ?''', (CLEANUP_POSTS_PER_BATCH,))
+    user_ids = [row[0] for row in c.fetchall()]
+    for user_id in user_ids:
+        purge_archived_posts(conn, user_id)
+        delete_notifications(c, 'user_id = ?', (user_id,))
+        remove_notification_actor(c, user_id)
+        c.execute('DELETE FROM batch_operations WHERE user_id = ?', (user_id,))
+        c.execute('SELECT id FROM upload_sessions WHERE user_id = ?', (user_id,))
+        for (session_id,) in c.fetchall():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(upload_part_path(session_id))
+        c.execute('DELETE FROM upload_sessions WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.commit()
+    conn.close()
+    return len(user_ids)
+
+def purge_deleted_content():
+    return (run_batches(tombstone_deleted_users_posts) + run_batches(purge_deleted_users_activity)
+            + run_batches(purge_deleted_posts) + run_batches(purge_deleted_users))
+
+def collect_media_garbage(grace_seconds=MEDIA_GC_GRACE_SECONDS):
+    # Mark: the raw digest of every hash referenced by a post, hot (tombstones
+    # included, until purged) or archived - 32 bytes per distinct image
+    conn = get_db_connection()
+    c = conn.cursor()
+    marked = {bytes.fromhex(row[0]) for row in c.execute('''SELECT media_hash FROM posts WHERE media_hash IS NOT NULL
+                                                            UNION SELECT media_hash FROM post_media''')}
+    for month in get_archive_months(conn):
+        attach_partition(conn, month)
+        try:
+            query = 'SELECT media_hash FROM archive.posts WHERE media_hash IS NOT NULL'
+            if archive_columns(conn, 'post_media'):
+                query += ' UNION SELECT media_hash FROM archive.post_media'
+            marked.update(bytes.fromhex(row[0]) for row in conn.execute(query))
+        finally:
+            conn.execute('DETACH DATABASE archive')
+    
+    # Sweep blob rows; the NOT EXISTS re-check covers posts created since the mark
+    c.execute("""SELECT sha256 FROM media_blobs WHERE created_at < datetime('now', ?)""",
+              (f'-{int(grace_seconds)} seconds',))
+    unmarked = [media_hash for (media_hash,) in c.fetchall() if bytes.fromhex(media_hash) not in marked]
+    swept_rows = 0
+    for start in range(0, len(unmarked), CLEANUP_BATCH_SIZE):
+        for media_hash in unmarked[start:start + CLEANUP_BATCH_SIZE]:
+            c.execute('''DELETE FROM media_blobs WHERE sha256 = ?
+                         AND NOT EXISTS (SELECT 1 FROM posts WHERE media_hash = ?)
+                         AND NOT EXISTS (SELECT 1 FROM post_media WHERE media_hash = ?)''',
+                      (media_hash, media_hash, media_hash))
+            swept_rows += c.rowcount
+        conn.commit()
+        time.sleep(CLEANUP_BATCH_PAUSE)
+    
+    # Sweep files with neither a reference nor a blob row, left alone for the
+    # grace period so an upload in progress is never caught between steps
+    swept_files = swept_bytes = 0
+    cutoff = time.time() - grace_seconds
+    upload_folder = app.config['UPLOAD_FOLDER']
+    for prefix in os.listdir(upload_folder) if os.path.isdir(upload_folder) else []:
+        directory = os.path.join(upload_folder, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue  # e.g. incoming/, owned by the upload session collector
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            media_hash = name.split('.', 1)[0]  # interrupted writes leave <hash>.<uuid>.tmp
+            if is_media_hash(media_hash) and name == media_hash and bytes.fromhex(media_hash) in marked:
+                continue
+            if is_media_hash(media_hash) and name == media_hash:
+                c.execute('SELECT 1 FROM media_blobs WHERE sha256 = ?', (media_hash,))
+                if c.fetchone():
+                    continue
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(path)
+                if stat.st_mtime < cutoff:
+                    os.remove(path)
+                    swept_files += 1
+                    swept_bytes += stat.st_size
+    conn.close()
+    return {'blobs': swept_rows, 'files': swept_files, 'bytes': swept_bytes} if swept_rows or swept_files else None
+
+def incremental_vacuum(pages=VACUUM_PAGES_PER_STEP, pause=CLEANUP_BATCH_PAUSE):
+    # Returns free pages to the filesystem a step at a time; each step is a
+    # short write, unlike a full VACUUM
+    conn = get_db_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.close()
+        return 0
+    freed = 0
+    while True:
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free_pages:
+            break
+        # execute() would step the pragma once, freeing a single page;
+        # executescript() runs it to completion
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        step = free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if step <= 0:
+            break  # pages freed meanwhile by another writer keep for the next run
+        freed += step
+        time.sleep(pause)
+    conn.close()
+    return freed
+
+def vacuum_database():
+    # One-off full VACUUM that also switches older databases to incremental
+    # auto-vacuum; it rewrites the whole file under an exclusive lock
+    conn = get_db_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.close()
+    return os.path.getsize(app.config['DATABASE'])
+
+# Backup and export
+# `backup` copies the live database (and every archive partition) with SQLite's
+# online backup API a few pages at a time, releasing the read lock between
+# steps so writers keep going. Note SQLite restarts a step-wise backup when
+# another connection writes to the source, so under sustained writes it takes
+# longer rather than blocking anyone.
+# `export`/`import` move an instance as NDJSON - one {"table", "row"} record per
+# line - with media files copied beside it. Both stream rows through cursors
+# and files through fixed-size buffers, so memory stays flat at any size.
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.01    # seconds between steps
+EXPORT_TABLES = ('users', 'media_blobs', 'posts', 'post_media', 'likes', 'comments')
+EXPORT_FETCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500     # records per import transaction
+
+def backup_sqlite_file(source_path, destination_path):
+    tmp_path = f'{destination_path}.{uuid.uuid4().hex}.tmp'
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_PAUSE)
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, destination_path)
+    return os.path.getsize(destination_path)
+
+def backup_database(destination):
+    # Writes <destination>/<database> plus <destination>/archive/*.db. Media
+    # files are immutable and content-addressed, so they can simply be synced.
+    os.makedirs(os.path.join(destination, 'archive'), exist_ok=True)
+    database = app.config['DATABASE']
+    total_bytes = backup_sqlite_file(database, os.path.join(destination, os.path.basename(database)))
+    conn = get_db_connection()
+    months = get_archive_months(conn)
+    conn.close()
+    for month in months:
+        total_bytes += backup_sqlite_file(archive_path(month),
+                                          os.path.join(destination, 'archive', f'posts_{month}.db'))
+    return {'files': 1 + len(months), 'bytes': total_bytes}
+
+def iter_table_rows(conn, table):
+    c = conn.execute(f'SELECT * FROM {table}')
+    columns = [column[0] for column in c.description]
+    while True:
+        rows = c.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def copy_file_hashed(source_path, destination_path):
+    # Streams source to destination (atomically) and returns its SHA-256
+    digest = hashlib.sha256()
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    tmp_path = f'{destination_path}.{uuid.uuid4().hex}.tmp'
+    with open(source_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1 << 16), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    os.replace(tmp_path, destination_path)
+    return digest.hexdigest()
+
+def export_ndjson(destination):
+    os.makedirs(destination, exist_ok=True)
+    counts = dict.fromkeys(EXPORT_TABLES, 0)
+    conn = get_db_connection()
+    with open(os.path.join(destination, 'data.ndjson'), 'w', encoding='utf-8') as out:
+        # One read transaction gives a consistent snapshot of the hot database
+        # without blocking writers (WAL). Archives are read afterwards, so a
+        # post archived mid-export shows up twice rather than not at all;
+        # import keeps the last copy by id.
+        conn.execute('BEGIN')
+        months = get_archive_months(conn)
+        for table in EXPORT_TABLES:
+            for row in iter_table_rows(conn, table):
+                if table == 'media_blobs':
+                    path = media_path(row['sha256'])
+                    if not os.path.exists(path):
+                        continue
+                    copy_file_hashed(path, os.path.join(destination, 'media', row['sha256'][:2], row['sha256']))
+                out.write(json.dumps({'table': table, 'row': row}) + '\n')
+                counts[table] += 1
+        conn.rollback()
+        
+        for month in months:
+            archive_conn = sqlite3.connect(archive_path(month))
+            for table in ARCHIVE_TABLES:
+                if not archive_columns(archive_conn, table, schema='main'):
+                    continue  # the partition predates the table
+                for row in iter_table_rows(archive_conn, table):
+                    out.write(json.dumps({'table': table, 'row': row}) + '\n')
+                    counts[table] += 1
+            archive_conn.close()
+    conn.close()
+    return counts
+
+def import_ndjson(source, batch_size=IMPORT_BATCH_SIZE):
+    # Rows keep their ids and replace any existing row with the same key, so
+    # this is meant for loading into a fresh instance (re-running is safe).
+    # Only columns the local schema knows are written.
+    counts = dict.fromkeys(EXPORT_TABLES, 0)
+    conn = get_db_connection()
+    conn.execute('PRAGMA foreign_keys = OFF')  # REPLACE of a parent row would trip them mid-load
+    c = conn.cursor()
+    columns = {table: {row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()}
+               for table in EXPORT_TABLES}
+    pending = 0
+    try:
+        with open(os.path.join(source, 'data.ndjson'), encoding='utf-8') as records:
+            for line in records:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                table, row = record['table'], record['row']
+                if table not in columns:
+                    continue
+                if table == 'media_blobs':
+                    media_hash = row['sha256']
+                    if not is_media_hash(media_hash):
+                        raise ValueError(f'invalid media hash {media_hash!r}')
+                    if not os.path.exists(media_path(media_hash)):
+                        if copy_file_hashed(os.path.join(source, 'media', media_hash[:2], media_hash),
+                                            media_path(media_hash)) != media_hash:
+                            os.remove(media_path(media_hash))
+                            raise ValueError(f'media file {media_hash} does not match its hash')
+                row = {key: value for key, value in row.items() if key in columns[table]}
+                c.execute(f'''INSERT OR REPLACE INTO {table} ({', '.join(row)})
+                              VALUES ({', '.join('?' * len(row))})''', list(row.values()))
+                counts[table] += 1
+                pending += 1
+                if pending >= batch_size:
+                    conn.commit()
+                    pending = 0
+        conn.commit()
+    finally:
+        conn.close()
+    return counts
+
+# Feed ranking
+# Each post's score is log2 of the sum of its events' weights, every event
+# scaled by 2^(age/half_life) relative to a fixed epoch. All posts decay by the
+# same factor over time, so the ordering stays correct without ever rewriting
+# old rows: a like or comment only adds (or removes) one term.
+RANK_EPOCH = 1577836800  # 2020-01-01 UTC
+RANK_WEIGHTS = {'post': 1.0, 'like': 1.0, 'comment': 2.0}
+FEED_ORDERINGS = {
+    'recent': 'p.created_at DESC, p.id DESC',
+    'top': 'p.rank_score DESC',
+}
+
+def rank_exponent(weight, event_time, half_life_hours):
+    return math.log2(weight) + (event_time - RANK_EPOCH) / (half_life_hours * 3600)
+
+def rank_add(score, weight, event_time, half_life_hours):
+    term = rank_exponent(weight, event_time, half_life_hours)
+    if score is None:
+        return term
+    high, low = max(score, term), min(score, term)
+    return high + math.log2(1 + 2 ** (low - high))
+
+def rank_remove(score, weight, event_time, half_life_hours):
+    # Returns None when the subtraction loses all precision; the caller then
+    # recomputes the score from the post's events instead
+    term = rank_exponent(weight, event_time, half_life_hours)
+    if score is None or term >= score:
+        return None
+    remainder = 1 - 2 ** (term - score)
+    if remainder < 1e-9:
+        return None
+    return score + math.log2(remainder)
+
+def compute_post_score(c, post_id, half_life_hours):
+    c.execute("""SELECT 'post', CAST(strftime('%s', created_at) AS INTEGER) FROM posts WHERE id = ?
+                 UNION ALL SELECT 'like', CAST(strftime('%s', created_at) AS INTEGER) FROM likes WHERE post_id = ?
+                 UNION ALL SELECT 'comment', CAST(strftime('%s', created_at) AS INTEGER) FROM comments WHERE post_id = ?""",
+              (post_id, post_id, post_id))
+    score = None
+    for kind, event_time in c.fetchall():
+        score = rank_add(score, RANK_WEIGHTS[kind], event_time, half_life_hours)
+    return score
+
+def update_post_score(c, post_id, kind, event_time, remove=False):
+    # Runs inside the caller's write transaction
+    half_life_hours = float(app.config['RANK_HALF_LIFE_HOURS'])
+    c.execute('SELECT rank_score FROM posts WHERE id = ?', (post_id,))
+    row = c.fetchone()
+    if row is None:
+        return
+    if remove:
+        score = rank_remove(row[0], RANK_WEIGHTS[kind], event_time, half_life_hours)
+        if score is None:
+            score = compute_post_score(c, post_id, half_life_hours)
+    else:
+        score = rank_add(row[0], RANK_WEIGHTS[kind], event_time, half_life_hours)
+    c.execute('UPDATE posts SET rank_score = ? WHERE id = ?', (score, post_id))
+
+def recompute_rank_scores():
+    # Needed after changing RANK_HALF_LIFE_HOURS, since stored scores embed it
+    conn = get_db_connection()
+    c = conn.cursor()
+    half_life_hours = float(app.config['RANK_HALF_LIFE_HOURS'])
+    c.execute('SELECT id FROM posts')
+    post_ids = [row[0] for row in c.fetchall()]
+    for post_id in post_ids:
+        c.execute('UPDATE posts SET rank_score = ? WHERE id = ?',
+                  (compute_post_score(c, post_id, half_life_hours), post_id))
+    conn.commit()
+    conn.close()
+    return len(post_ids)
+
+# Media storage and deduplication
+# Images are stored once per SHA-256 under UPLOAD_FOLDER and shared between
+# posts through media_blobs.ref_count. A 64-bit difference hash (dHash) is kept
+# per blob so near-duplicates can be found with a BK-tree over Hamming distance.
+SIMILAR_MEDIA_MAX_DISTANCE = 6  # bits out of 64
+PLACEHOLDER_SIZE = 16           # longest edge of the inline preview, in pixels
+PLACEHOLDER_QUALITY = 40
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+def sniff_content_type(image_bytes):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return content_type
+    return 'image/jpeg'
+
+def is_media_hash(value):
+    return len(value) == 64 and all(ch in '0123456789abcdef' for ch in value)
+
+def media_path(media_hash):
+    # Fan out by prefix so no single directory grows unbounded
+    return os.path.join(app.config['UPLOAD_FOLDER'], media_hash[:2], media_hash)
+
+def media_url(media_hash, image_data=''):
+    # Posts created before the blob store may still carry inline base64
+    if media_hash:
+        return f'/media/{media_hash}'
+    return f'data:image/jpeg;base64,{image_data}'
+
+def post_image_html(src, width, height, placeholder, eager=False):
+    # Lazy-load everything below the first post; width/height reserve the box
+    # and the inline placeholder paints behind it until the real image decodes
+    attrs = [f'src="{src}"', 'alt="Post image"', 'class="post-image"', 'decoding="async"']
+    attrs.append('loading="eager" fetchpriority="high"' if eager else 'loading="lazy"')
+    if width and height:
+        attrs.append(f'width="{width}" height="{height}"')
+    if placeholder:
+        attrs.append(f'style="background-image: url({placeholder})"')
+    return f'<img {" ".join(attrs)}>'
+
+# Carousel posts
+# Up to CAROUSEL_MAX_ITEMS images per post. Hashing, Pillow decoding and file
+# writes release the GIL, so a carousel's images are prepared side by side on
+# a short-lived pool; single-image posts skip the pool entirely.
+CAROUSEL_MAX_ITEMS = 10
+MEDIA_PREPARE_WORKERS = 4
+
+def map_media(fn, *iterables):
+    items = list(zip(*iterables))
+    if len(items) < 2:
+        return [fn(*item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MEDIA_PREPARE_WORKERS),
+                            thread_name_prefix='media-prepare') as pool:
+        return list(pool.map(fn, *zip(*items)))
+
+def media_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def prepare_media(media_hash, image_bytes):
+    # Everything a new blob needs outside the write transaction
+    write_media_file(media_hash, image_bytes)
+    return analyze_image(image_bytes)
+
+def carousel_html(post, cover_html):
+    if post.media_count <= 1:
+        return cover_html
+    partition = f' data-partition="{post.partition}"' if post.partition else ''
+    return f'''<div class="carousel" data-index="0" data-count="{post.media_count}"{partition}>
+                    {cover_html}
+                    <button class="carousel-prev" onclick="stepCarousel({post.id}, -1)">‹</button>
+                    <button class="carousel-next" onclick="stepCarousel({post.id}, 1)">›</button>
+                    <span class="carousel-counter">1/{post.media_count}</span>
+                </div>'''
+
+def write_media_file(media_hash, image_bytes):
+    path = media_path(media_hash)
+    if os.path.exists(path):
+        os.utime(path)  # a fresh mtime keeps the media collector's grace period
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(image_bytes)
+    os.replace(tmp_path, path)
+    return path
+
+def analyze_image(image_bytes):
+    # A single decode yields the perceptual hash, intrinsic size and a tiny
+    # JPEG placeholder (a few hundred bytes) that is inlined into the feed
+    info = {'phash': None, 'width': None, 'height': None, 'placeholder': None}
+    if Image is None:
+        return info
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            info['width'], info['height'] = img.size
+            img.draft('RGB', (64, 64))  # let the JPEG decoder downscale for us
+            small = img.convert('RGB')
+            pixels = list(small.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+            small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            buffer = io.BytesIO()
+            small.save(buffer, 'JPEG', quality=PLACEHOLDER_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"Error analyzing image: {e}")
+        return info
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    info['phash'] = f'{bits:016x}'
+    info['placeholder'] = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    return info
+
+def store_media_blob(c, media_hash, image_bytes, info):
+    # Runs inside the caller's transaction; the file write is idempotent.
+    # info is None when the blob already exists and only needs another reference
+    write_media_file(media_hash, image_bytes)
+    info = info or {}
+    c.execute('''INSERT INTO media_blobs (sha256, phash, size_bytes, content_type, width, height, placeholder)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1''',
+              (media_hash, info.get('phash'), len(image_bytes), sniff_content_type(image_bytes),
+               info.get('width'), info.get('height'), info.get('placeholder')))
+
+def get_media_blob(media_hash):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT sha256, content_type, phash FROM media_blobs WHERE sha256 = ? AND ref_count > 0',
+                  (media_hash,))
+        blob = c.fetchone()
+        conn.close()
+        return blob
+    except Exception as e:
+        print(f"Error getting media blob: {e}")
+        return None
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    def __init__(self):
+        self.root = None  # node: [value, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # Triangle inequality: only children within the band can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort()
+        return results
+
+class PerceptualHashIndex:
+    # Loaded lazily and topped up from media_blobs.id on every query, so blobs
+    # added by other worker processes become visible without a reload
+    def __init__(self):
+        self.tree = BKTree()
+        self.last_id = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT id, sha256, phash FROM media_blobs WHERE id > ? AND phash IS NOT NULL ORDER BY id',
+                  (self.last_id,))
+        for blob_id, media_hash, phash in c.fetchall():
+            self.tree.add(int(phash, 16), media_hash)
+            self.last_id = blob_id
+        conn.close()
+
+    def find_similar(self, phash, max_distance=SIMILAR_MEDIA_MAX_DISTANCE):
+        with self._lock:
+            self.refresh()
+            return self.tree.search(int(phash, 16), max_distance)
+
+phash_index = PerceptualHashIndex()
+
+def find_similar_posts(post_id, max_distance=SIMILAR_MEDIA_MAX_DISTANCE):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''SELECT m.phash FROM posts p JOIN media_blobs m ON m.sha256 = p.media_hash
+                     WHERE p.id = ?''', (post_id,))
+        row = c.fetchone()
+        if row is None or row[0] is None:
+            conn.close()
+            return []
+
+        matches = phash_index.find_similar(row[0], max_distance)
+        distances = {media_hash: distance for distance, media_hash in matches}
+        placeholders = ','.join('?' * len(distances))
+        c.execute(f'''SELECT p.id, p.media_hash, u.username FROM posts p
+                      JOIN users u ON p.user_id = u.id
+                      WHERE p.media_hash IN ({placeholders}) AND p.id != ?
+                      AND p.deleted_at IS NULL AND u.deleted_at IS NULL''',
+                  list(distances) + [post_id])
+        similar = [(distances[media_hash], similar_id, media_hash, username)
+                   for similar_id, media_hash, username in c.fetchall()]
+        conn.close()
+        similar.sort()
+        return similar
+    except Exception as e:
+        print(f"Error finding similar posts: {e}")
+        return []
+
+def get_dedup_report():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''SELECT COUNT(*), COALESCE(SUM(ref_count), 0), COALESCE(SUM(size_bytes), 0),
+                        COALESCE(SUM(size_bytes * ref_count), 0)
+                 FROM media_blobs WHERE ref_count > 0''')
+    blobs, references, stored_bytes, logical_bytes = c.fetchone()
+    conn.close()
+    saved_bytes = logical_bytes - stored_bytes
+    return {
+        'blobs': blobs,
+        'references': references,
+        'stored_bytes': stored_bytes,
+        'logical_bytes': logical_bytes,
+        'saved_bytes': saved_bytes,
+        'saved_ratio': saved_bytes / logical_bytes if logical_bytes else 0.0,
+    }
+
+# Resumable uploads
+# Create a session with the file's size and SHA-256, PUT chunks with an
+# Upload-Offset header (each appended to a temp file), ask for the offset after
+# a dropped connection, then finalize. A flaky connection only re-sends the
+# current chunk, and no request holds a worker for the whole transfer.
+# The temp file's size is the authoritative offset; an exclusive flock on it
+# serialises concurrent PUTs to the same session, across worker processes too.
+UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+UPLOAD_GC_BATCH_SIZE = 100
+UPLOAD_SESSION_COLUMNS = ', '.join(UploadSession.__slots__)
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+def upload_part_path(session_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'incoming', f'{session_id}.part')
+
+def get_upload_session(session_id, user_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.row_factory = UploadSession.row_factory
+    c.execute(f'SELECT {UPLOAD_SESSION_COLUMNS} FROM upload_sessions WHERE id = ? AND user_id = ?',
+              (session_id, user_id))
+    upload_session = c.fetchone()
+    conn.close()
+    if upload_session is None:
+        raise UploadError('Upload session not found', 404)
+    return upload_session
+
+def create_upload_session(user_id, filename, total_size, sha256, caption=''):
+    if not allowed_file(filename):
+        raise UploadError('Invalid file type. Please upload an image (PNG, JPG, JPEG, GIF)')
+    if not isinstance(total_size, int) or not 0 < total_size <= UPLOAD_MAX_BYTES:
+        raise UploadError(f'size must be between 1 and {UPLOAD_MAX_BYTES} bytes')
+    if not is_media_hash(sha256):
+        raise UploadError('sha256 must be a lowercase hex SHA-256 digest')
+    
+    # Collect a few abandoned sessions whenever a new one starts
+    gc_upload_sessions(UPLOAD_GC_BATCH_SIZE)
+    session_id = uuid.uuid4().hex
+    path = upload_part_path(session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    conn = get_db_connection()
+    conn.execute('''INSERT INTO upload_sessions (id, user_id, filename, caption, total_size, sha256)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                 (session_id, user_id, secure_filename(filename), caption, total_size, sha256))
+    conn.commit()
+    conn.close()
+    return session_id
+
+def append_upload_chunk(session_id, user_id, offset, stream, length):
+    upload_session = get_upload_session(session_id, user_id)
+    if length is None:
+        raise UploadError('Chunks need a Content-Length', 411)
+    if length > UPLOAD_CHUNK_MAX_BYTES:
+        raise UploadError(f'Chunks can be at most {UPLOAD_CHUNK_MAX_BYTES} bytes', 413)
+    
+    with open(upload_part_path(session_id), 'ab') as part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another chunk for this upload is in flight', 409)
+        received = part.seek(0, os.SEEK_END)
+        if offset != received:
+            raise UploadError('Offset mismatch', 409, offset=received)
+        if received + length > upload_session.total_size:
+            raise UploadError('Chunk runs past the declared size', 413, offset=received)
+        
+        # A connection that drops mid-chunk keeps what arrived; the client
+        # resumes from the offset it gets back
+        try:
+            while length:
+                data = stream.read(min(length, 1 << 16))
+                if not data:
+                    break
+                part.write(data)
+                length -= len(data)
+        finally:
+            part.flush()
+            received = part.tell()
+            conn = get_db_connection()
+            conn.execute('UPDATE upload_sessions SET received = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                         (received, session_id))
+            conn.commit()
+            conn.close()
+    return received
+
+def finalize_upload(session_id, user_id):
+    upload_session = get_upload_session(session_id, user_id)
+    path = upload_part_path(session_id)
+    with open(path, 'rb') as part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('A chunk for this upload is still in flight', 409)
+        received = part.seek(0, os.SEEK_END)
+        if received != upload_session.total_size:
+            raise UploadError('Upload is incomplete', 409, offset=received)
+        part.seek(0)
+        image_bytes = part.read()
+        if hashlib.sha256(image_bytes).hexdigest() != upload_session.sha256:
+            # Corrupt - the client has to start over
+            delete_upload_session(session_id, user_id)
+            raise UploadError('Uploaded data does not match sha256', 422)
+        
+        # The lock is held until the session is gone, and the session row is
+        # claimed before the post exists: a finalize that raced past the lock
+        # (holding the file open from before it was removed) finds no row
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('DELETE FROM upload_sessions WHERE id = ? AND user_id = ?', (session_id, user_id))
+        claimed = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        if not claimed:
+            raise UploadError('Upload session not found', 404)
+        if not create_post(user_id, [image_bytes], upload_session.caption):
+            restore_upload_session(upload_session)  # so the client can retry the finalize
+            raise UploadError('Could not create post', 500)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    return True
+
+def restore_upload_session(upload_session):
+    conn = get_db_connection()
+    conn.execute(f'''INSERT INTO upload_sessions ({UPLOAD_SESSION_COLUMNS})
+                     VALUES ({', '.join('?' * len(UploadSession.__slots__))})''',
+                 [getattr(upload_session, column) for column in UploadSession.__slots__])
+    conn.commit()
+    conn.close()
+
+def delete_upload_session(session_id, user_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('DELETE FROM upload_sessions WHERE id = ? AND user_id = ?', (session_id, user_id))
+    deleted = c.rowcount
+    conn.commit()
+    conn.close()
+    if deleted:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(upload_part_path(session_id))
+    return bool(deleted)
+
+def gc_upload_sessions(limit=None):
+    # Drops sessions idle for longer than UPLOAD_SESSION_TTL, oldest first
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""SELECT id FROM upload_sessions WHERE updated_at < datetime('now', ?)
+                 ORDER BY updated_at LIMIT ?""",
+              (f"-{int(app.config['UPLOAD_SESSION_TTL'])} seconds", -1 if limit is None else limit))
+    expired = [row[0] for row in c.fetchall()]
+    c.executemany('DELETE FROM upload_sessions WHERE id = ?', [(session_id,) for session_id in expired])
+    conn.commit()
+    conn.close()
+    for session_id in expired:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(upload_part_path(session_id))
+    return len(expired)
+
+# Activity notifications
+# Like and comment events are queued in memory and written by a background
+# flusher, one transaction per batch, so toggle_like/add_comment never pay for
+# an extra write. Events for the same (recipient, post, verb) collapse into a
+# single row ("alice and 41 others liked your photo"); notification_actors
+# records who is in each group, so repeat events from one actor count once.
+NOTIFICATION_FLUSH_INTERVAL = 2.0  # seconds between background flushes
+NOTIFICATION_FLUSH_SIZE = 500      # flush early once this many events are queued
+NOTIFICATIONS_PER_PAGE = 20
+
+NOTIFICATION_VERBS = {
+    'like': 'liked your photo',
+    'comment': 'commented on your photo',
+}
+
+class NotificationBuffer:
+    def __init__(self, flush_interval=NOTIFICATION_FLUSH_INTERVAL, flush_size=NOTIFICATION_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._events = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, verb, actor_id, post_id):
+        with self._lock:
+            self._events.append((verb, actor_id, post_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='notification-flusher', daemon=True)
+                self._thread.start()
+            if len(self._events) >= self.flush_size:
+                self._wakeup.set()
+
+    def reset_after_fork(self):
+        # The flusher thread does not survive fork; the child starts its own
+        self._events = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return 0
+
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+
+            # Resolve post authors for the whole batch in one query
+            post_ids = list({event[2] for event in events})
+            placeholders = ','.join('?' * len(post_ids))
+            c.execute(f'SELECT id, user_id FROM posts WHERE id IN ({placeholders})', post_ids)
+            authors = dict(c.fetchall())
+
+            # Collapse events per (recipient, post, verb) into the distinct
+            # actors in order of their latest event, skipping self-activity
+            groups = {}
+            for verb, actor_id, post_id in events:
+                recipient = authors.get(post_id)
+                if recipient is None or recipient == actor_id:
+                    continue
+                actors = groups.setdefault((recipient, post_id, verb), {})
+                actors.pop(actor_id, None)
+                actors[actor_id] = None
+
+            new_unread = {}
+            for (recipient, post_id, verb), actors in groups.items():
+                actor_id = next(reversed(actors))
+                c.execute('SELECT id, is_read FROM notifications WHERE user_id = ? AND post_id = ? AND verb = ?',
+                          (recipient, post_id, verb))
+                existing = c.fetchone()
+                if existing is None:
+                    c.execute('''INSERT INTO notifications (user_id, post_id, verb, actor_count, last_actor_id)
+                                 VALUES (?, ?, ?, ?, ?)''', (recipient, post_id, verb, len(actors), actor_id))
+                    notification_id = c.lastrowid
+                    new_unread[recipient] = new_unread.get(recipient, 0) + 1
+                elif existing[1]:
+                    # Already seen - start a fresh unread group
+                    notification_id = existing[0]
+                    c.execute('DELETE FROM notification_actors WHERE notification_id = ?', (notification_id,))
+                    c.execute('''UPDATE notifications SET actor_count = ?, last_actor_id = ?, is_read = 0,
+                                 updated_at = CURRENT_TIMESTAMP WHERE id = ?''', (len(actors), actor_id, notification_id))
+                    new_unread[recipient] = new_unread.get(recipient, 0) + 1
+                else:
+                    notification_id = existing[0]
+                c.executemany('INSERT OR IGNORE INTO notification_actors (notification_id, actor_id) VALUES (?, ?)',
+                              [(notification_id, actor) for actor in actors])
+                if existing is not None and not existing[1]:
+                    # Only actors new to the group add to its count
+                    c.execute('''UPDATE notifications SET actor_count = actor_count + ?, last_actor_id = ?,
+                                 updated_at = CURRENT_TIMESTAMP WHERE id = ?''', (c.rowcount, actor_id, notification_id))
+
+            c.executemany('UPDATE users SET unread_notifications = unread_notifications + ? WHERE id = ?',
+                          [(delta, recipient) for recipient, delta in new_unread.items()])
+            conn.commit()
+            conn.close()
+            return len(events)
+        except Exception as e:
+            print(f"Error flushing notifications: {e}")
+            return 0
+
+notification_buffer = NotificationBuffer()
+atexit.register(notification_buffer.flush)
+os.register_at_fork(after_in_child=notification_buffer.reset_after_fork)
+
+def format_notification(verb, actor_count, actor_username):
+    action = NOTIFICATION_VERBS.get(verb, verb)
+    others = actor_count - 1
+    if others <= 0:
+        return f"{actor_username} {action}"
+    return f"{actor_username} and {others} {'other' if others == 1 else 'others'} {action}"
+
+def get_notifications(user_id, page=1, per_page=NOTIFICATIONS_PER_PAGE):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.row_factory = Notification.row_factory
+        c.execute('''SELECT n.id, n.post_id, n.verb, n.actor_count, u.username, n.is_read, n.updated_at
+                     FROM notifications n
+                     JOIN users u ON n.last_actor_id = u.id
+                     JOIN posts p ON n.post_id = p.id
+                     WHERE n.user_id = ? AND p.deleted_at IS NULL AND u.deleted_at IS NULL
+                     ORDER BY n.updated_at DESC, n.id DESC
+                     LIMIT ? OFFSET ?''', (user_id, per_page + 1, (page - 1) * per_page))
+        notifications = c.fetchall()
+        conn.close()
+        return notifications
+    except Exception as e:
+        print(f"Error getting notifications: {e}")
+        return []
+
+def get_unread_notification_count(user_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT unread_notifications FROM users WHERE id = ?', (user_id,))
+        result = c.fetchone()
+        conn.close()
+        return result[0] if result else 0
+    except Exception as e:
+        print(f"Error getting unread count: {e}")
+        return 0
+
+def mark_notifications_read(user_id):
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('UPDATE notifications SET is_read = 1 WHERE user_id = ? AND is_read = 0', (user_id,))
+        c.execute('UPDATE users SET unread_notifications = 0 WHERE id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error marking notifications read: {e}")
+        return False
+
+def delete_notifications(c, where, params):
+    # Inside the caller's transaction; unread rows come off their recipients'
+    # unread_notifications, so the badge never counts rows that are gone
+    c.execute(f'DELETE FROM notifications WHERE {where} RETURNING user_id, is_read', params)
+    rows = c.fetchall()
+    unread = {}
+    for user_id, is_read in rows:
+        if not is_read:
+            unread[user_id] = unread.get(user_id, 0) + 1
+    c.executemany('UPDATE users SET unread_notifications = MAX(unread_notifications - ?, 0) WHERE id = ?',
+                  [(count, user_id) for user_id, count in unread.items()])
+    return len(rows)
+
+def remove_notification_actor(c, actor_id):
+    # Takes a purged account out of the groups it acted in. Groups with other
+    # actors keep going with one fewer (and a remaining actor as last_actor);
+    # groups it was alone in are deleted.
+    c.execute('DELETE FROM notification_actors WHERE actor_id = ? RETURNING notification_id', (actor_id,))
+    for (notification_id,) in c.fetchall():
+        c.execute('SELECT MAX(actor_id) FROM notification_actors WHERE notification_id = ?', (notification_id,))
+        remaining = c.fetchone()[0]
+        if remaining is None:
+            delete_notifications(c, 'id = ?', (notification_id,))
+        else:
+            c.execute('''UPDATE notifications SET actor_count = MAX(actor_count - 1, 1),
+                         last_actor_id = CASE WHEN last_actor_id = ? THEN ? ELSE last_actor_id END
+                         WHERE id = ?''', (actor_id, remaining, notification_id))
+    # Anything still naming the account predates notification_actors
+    delete_notifications(c, 'last_actor_id = ?', (actor_id,))
+
+# Trending posts and tags
+# Activity is counted in per-process count-min sketches, one per time bucket,
+# plus a running sum over the window so an update is a fixed number of array
+# increments. A small candidate set of the heaviest items (the top-K) is kept
+# alongside; everything else only lives in the sketches, so memory is bounded
+# by the sketch size no matter how many posts or tags are active.
+# Workers run in separate processes, so each one snapshots its own buckets to
+# trending_snapshots every TRENDING_SNAPSHOT_INTERVAL seconds and a query adds
+# the other processes' snapshots to its live counts. Snapshots of processes
+# that have exited still count until they age out, so a restart keeps the
+# window. Hashtags come from captions and comments.
+TRENDING_KINDS = ('post', 'tag')
+TRENDING_WEIGHTS = {'post': 1, 'like': 1, 'comment': 2}  # integer sketch counts
+TRENDING_BUCKET_SECONDS = 300
+TRENDING_WINDOW_BUCKETS = 12        # one hour
+TRENDING_SKETCH_WIDTH = 1024
+TRENDING_SKETCH_DEPTH = 4           # 32 KiB per sketch
+TRENDING_CANDIDATES = 100           # heavy hitters tracked per kind
+TRENDING_SNAPSHOT_INTERVAL = 30.0   # seconds
+HASHTAG_PATTERN = re.compile(r'#(\w{1,50})')
+
+def extract_hashtags(text):
+    return {tag.lower() for tag in HASHTAG_PATTERN.findall(text or '')}
+
+class CountMinSketch:
+    __slots__ = ('width', 'depth', 'table')
+
+    def __init__(self, width=TRENDING_SKETCH_WIDTH, depth=TRENDING_SKETCH_DEPTH, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else array('q', bytes(8 * width * depth))
+
+    def _cells(self, item):
+        # One BLAKE2b digest gives every row's index; unlike hash() it is stable
+        # across processes, so snapshots from different workers can be summed
+        digest = hashlib.blake2b(str(item).encode(), digest_size=4 * self.depth).digest()
+        return [row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        for cell in self._cells(item):
+            self.table[cell] += count
+
+    def estimate(self, item):
+        return min(self.table[cell] for cell in self._cells(item))
+
+    def merge(self, other, sign=1):
+        table = self.table
+        for cell, count in enumerate(other.table):
+            if count:
+                table[cell] += sign * count
+
+    def to_bytes(self):
+        return self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, width=TRENDING_SKETCH_WIDTH, depth=TRENDING_SKETCH_DEPTH):
+        table = array('q')
+        table.frombytes(data)
+        return cls(width, depth, table)
+
+class SlidingWindowSketch:
+    def __init__(self, bucket_seconds=TRENDING_BUCKET_SECONDS, window_buckets=TRENDING_WINDOW_BUCKETS,
+                 max_candidates=TRENDING_CANDIDATES):
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        self.max_candidates = max_candidates
+        self.buckets = OrderedDict()  # bucket number -> CountMinSketch
+        self.window = CountMinSketch()
+        self.candidates = {}          # item -> window estimate at last touch
+        self.dirty = set()            # buckets changed since the last snapshot
+
+    def bucket_for(self, now):
+        return int(now // self.bucket_seconds)
+
+    def rotate(self, now):
+        bucket = self.bucket_for(now)
+        expired = False
+        while self.buckets and next(iter(self.buckets)) <= bucket - self.window_buckets:
+            _, sketch = self.buckets.popitem(last=False)
+            self.window.merge(sketch, sign=-1)
+            expired = True
+        if expired:
+            # Re-rank candidates so stale heavy hitters can be displaced
+            estimates = ((item, self.window.estimate(item)) for item in self.candidates)
+            self.candidates = {item: estimate for item, estimate in estimates if estimate > 0}
+        if bucket not in self.buckets:
+            self.buckets[bucket] = CountMinSketch()
+        return bucket
+
+    def add(self, item, count, now):
+        bucket = self.rotate(now)
+        self.buckets[bucket].add(item, count)
+        self.window.add(item, count)
+        self.dirty.add(bucket)
+        
+        estimate = self.window.estimate(item)
+        if item in self.candidates or len(self.candidates) < self.max_candidates:
+            self.candidates[item] = estimate
+            return
+        # max_candidates is a small constant, so this scan is bounded
+        weakest = min(self.candidates, key=self.candidates.get)
+        if estimate > self.candidates[weakest]:
+            del self.candidates[weakest]
+            self.candidates[item] = estimate
+
+class TrendingEngine:
+    def __init__(self, snapshot_interval=TRENDING_SNAPSHOT_INTERVAL):
+        self.snapshot_interval = snapshot_interval
+        self._sketches = {kind: SlidingWindowSketch() for kind in TRENDING_KINDS}
+        self._others = {}  # kind -> (loaded_at, merged sketch, candidates) from other processes
+        self._lock = threading.Lock()
+        self._thread = None
+        # Random rather than host:pid - a restarted process (PID 1 in a
+        # container) would otherwise take over a dead process's snapshots
+        self.owner = uuid.uuid4().hex
+
+    def record(self, verb, post_id, text=''):
+        now = time.time()
+        with self._lock:
+            self._sketches['post'].add(post_id, TRENDING_WEIGHTS[verb], now)
+            for tag in extract_hashtags(text):
+                self._sketches['tag'].add(tag, 1, now)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trending-snapshots', daemon=True)
+                self._thread.start()
+
+    def reset_after_fork(self):
+        # Counts recorded before the fork belong to the parent
+        self._sketches = {kind: SlidingWindowSketch() for kind in TRENDING_KINDS}
+        self._others = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.owner = uuid.uuid4().hex
+
+    def _run(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self.snapshot()
+
+    def snapshot(self):
+        now = time.time()
+        rows = []
+        with self._lock:
+            for kind, window in self._sketches.items():
+                window.rotate(now)
+                candidates = json.dumps(list(window.candidates))
+                for bucket in window.dirty:
+                    if bucket in window.buckets:
+                        rows.append((self.owner, kind, bucket, window.buckets[bucket].to_bytes(), candidates))
+                window.dirty.clear()
+        if not rows:
+            return 0
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.executemany('INSERT OR REPLACE INTO trending_snapshots VALUES (?, ?, ?, ?, ?)', rows)
+            c.execute('DELETE FROM trending_snapshots WHERE bucket <= ?',
+                      (int(now // TRENDING_BUCKET_SECONDS) - TRENDING_WINDOW_BUCKETS,))
+            conn.commit()
+            conn.close()
+            return len(rows)
+        except Exception as e:
+            print(f"Error saving trending snapshot: {e}")
+            return 0
+
+    def _load_others(self, kind, now):
+        # Cached for one snapshot interval - they can't be fresher than that
+        cached = self._others.get(kind)
+        if cached is not None and now - cached[0] < self.snapshot_interval:
+            return cached[1], cached[2]
+        merged, candidates = CountMinSketch(), set()
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''SELECT sketch, candidates FROM trending_snapshots
+                     WHERE kind = ? AND bucket > ? AND owner != ?''',
+                  (kind, int(now // TRENDING_BUCKET_SECONDS) - TRENDING_WINDOW_BUCKETS, self.owner))
+        for sketch, items in c:
+            merged.merge(CountMinSketch.from_bytes(sketch))
+            candidates.update(json.loads(items))
+        conn.close()
+        self._others[kind] = (now, merged, candidates)
+        return merged, candidates
+
+    def top(self, kind, limit=10):
+        now = time.time()
+        others, other_candidates = self._load_others(kind, now)
+        with self._lock:
+            window = self._sketches[kind]
+            window.rotate(now)
+            scores = {item: window.window.estimate(item) + others.estimate(item)
+                      for item in set(window.candidates) | other_candidates}
+        ranked = sorted(((score, item) for item, score in scores.items() if score > 0), reverse=True)
+        return [(item, score) for score, item in ranked[:limit]]
+
+trending = TrendingEngine()
+atexit.register(trending.snapshot)
+os.register_at_fork(after_in_child=trending.reset_after_fork)
+
+def get_trending_posts(limit=10):
+    # Posts may have been archived since they were counted; those drop out
+    ranked = trending.top('post', limit * 2)
+    if not ranked:
+        return []
+    scores = dict(ranked)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.row_factory = Post.row_factory
+    c.execute(f'''SELECT {', '.join(FEED_POST_COLUMNS)}, NULL
+                  FROM posts p
+                  JOIN users u ON p.user_id = u.id
+                  LEFT JOIN media_blobs m ON m.sha256 = p.media_hash
+                  WHERE p.id IN ({','.join('?' * len(scores))})
+                  AND p.deleted_at IS NULL AND u.deleted_at IS NULL''', list(scores))
+    posts = c.fetchall()
+    conn.close()
+    posts.sort(key=lambda post: scores[post.id], reverse=True)
+    return [(post, scores[post.id]) for post in posts[:limit]]
+
+# Server-side sessions
+# The cookie carries only an opaque random id and a version, "<id>.<version>";
+# session data lives in SQLite (keyed by the id's SHA-256) with an in-process
+# LRU in front. The version is bumped on every change, so a cached entry whose
+# version matches the cookie is current and needs no query; other workers'
+# writes show up as a version mismatch. A request only sets the cookie when the
+# session actually changed. Each cached entry is still re-read (and its
+# last_seen touched) every SESSION_REVALIDATE_SECONDS, which bounds how long a
+# revocation made by another worker takes to land.
+SESSION_CACHE_SIZE = 4096
+SESSION_REVALIDATE_SECONDS = 30
+SESSION_SWEEP_BATCH_SIZE = 500
+
+def session_key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, version=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.loaded = json.dumps(initial or {}, sort_keys=True)
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        # New id on privilege change (login/logout), so a pre-login id is useless
+        self.rotate = True
+        self.modified = True
+
+class SessionStore:
+    def __init__(self, max_entries=SESSION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> [version, data, checked_at]
+        self._lock = threading.Lock()
+
+    def _cache(self, key, version, data, now):
+        with self._lock:
+            self._entries[key] = [version, data, now]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load(self, sid, version):
+        # Returns (data, version), or None for unknown, revoked or idle sessions
+        key, now = session_key(sid), time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and now - entry[2] < SESSION_REVALIDATE_SECONDS:
+                self._entries.move_to_end(key)
+                return json.loads(entry[1]), entry[0]
+        
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT version, data, last_seen FROM sessions WHERE id = ?', (key,))
+        row = c.fetchone()
+        if row is None or now - row[2] > float(app.config['SESSION_IDLE_TIMEOUT']):
+            if row is not None:
+                c.execute('DELETE FROM sessions WHERE id = ?', (key,))
+                conn.commit()
+            conn.close()
+            self.forget(key)
+            return None
+        c.execute('UPDATE sessions SET last_seen = ? WHERE id = ?', (now, key))
+        conn.commit()
+        conn.close()
+        self._cache(key, row[0], row[1], now)
+        return json.loads(row[1]), row[0]
+
+    def save(self, sid, data):
+        # Returns the new version
+        key, now = session_key(sid), time.time()
+        payload = json.dumps(data, sort_keys=True)
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''INSERT INTO sessions (id, user_id, data, last_seen) VALUES (?, ?, ?, ?)
+                     ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, data = excluded.data,
+                     version = version + 1, last_seen = excluded.last_seen
+                     RETURNING version''', (key, data.get('user_id'), payload, now))
+        version = c.fetchone()[0]
+        conn.commit()
+        conn.close()
+        self._cache(key, version, payload, now)
+        return version
+
+    def delete(self, sid):
+        key = session_key(sid)
+        conn = get_db_connection()
+        conn.execute('DELETE FROM sessions WHERE id = ?', (key,))
+        conn.commit()
+        conn.close()
+        self.forget(key)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def revoke_user(self, user_id, keep_sid=None):
+        # Signs the user out everywhere (optionally except the current session)
+        keep_key = session_key(keep_sid) if keep_sid else ''
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('SELECT id FROM sessions WHERE user_id = ? AND id != ?', (user_id, keep_key))
+        keys = [row[0] for row in c.fetchall()]
+        c.executemany('DELETE FROM sessions WHERE id = ?', [(key,) for key in keys])
+        conn.commit()
+        conn.close()
+        for key in keys:
+            self.forget(key)
+        return len(keys)
+
+    def sweep(self, batch_size=SESSION_SWEEP_BATCH_SIZE, pause=0.05):
+        # Deletes idle sessions in short batches so writers aren't held up
+        cutoff = time.time() - float(app.config['SESSION_IDLE_TIMEOUT'])
+        total = 0
+        while True:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute('''DELETE FROM sessions WHERE id IN
+                         (SELECT id FROM sessions WHERE last_seen < ? LIMIT ?)''', (cutoff, batch_size))
+            deleted = c.rowcount
+            conn.commit()
+            conn.close()
+            total += deleted
+            if deleted < batch_size:
+                break
+            time.sleep(pause)
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[2] < cutoff]:
+                del self._entries[key]
+        return total
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+
+session_store = SessionStore()
+os.register_at_fork(after_in_child=session_store.reset_after_fork)
+
+class SqliteSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app), '')
+        sid, _, version = cookie.rpartition('.')
+        if sid and version.isdigit():
+            loaded = session_store.load(sid, int(version))
+            if loaded is not None:
+                return ServerSideSession(loaded[0], sid, loaded[1])
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.modified:
+            return
+        
+        if session.sid and (session.rotate or not session):
+            session_store.delete(session.sid)
+            session.sid = None
+        if not session:
+            if session.loaded != '{}':
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+        if session.sid and json.dumps(dict(session), sort_keys=True) == session.loaded:
+            return  # e.g. a flash that was added and shown in the same request
+        
+        sid = session.sid or secrets.token_urlsafe(32)
+        version = session_store.save(sid, dict(session))
+        response.set_cookie(name, f'{sid}.{version}', expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+app.session_interface = SqliteSessionInterface()
+
+def sweep_idle_sessions():
+    return session_store.sweep()
+
+def render_flash_messages():
+    # Only touches the session when there is something to show
+    return ''.join(
+        f'<div class="alert {"alert-success" if category == "message" else "alert-error"}">{message}</div>'
+        for category, message in get_flashed_messages(with_categories=True)
+    )
+
+# Rate limiting and load shedding
+# Per-route token buckets keyed by user id and by client IP. Each limiter keeps
+# its buckets in an LRU so idle keys are evicted and memory stays bounded.
+# Limits are (tokens refilled per second, burst size); only the listed
+# methods are counted, so viewing the login/upload forms stays free.
+RATE_LIMITS = {
+    'like_post': {'methods': {'POST'}, 'user': (5, 30), 'ip': (20, 100)},
+    'comment_post': {'methods': {'POST'}, 'user': (1, 10), 'ip': (5, 30)},
+    'upload': {'methods': {'POST'}, 'user': (0.1, 5), 'ip': (0.5, 20)},
+    'upload_sessions_api': {'methods': {'POST'}, 'user': (0.1, 5), 'ip': (0.5, 20)},
+    'login': {'methods': {'POST'}, 'ip': (0.2, 10)},
+    'api_batch': {'methods': {'POST'}, 'user': (0.5, 10), 'ip': (2, 30)},
+}
+RATE_LIMIT_MAX_KEYS = 10000  # buckets kept per limiter before LRU eviction
+# /api/batch operations are charged to the route each one stands in for
+BATCH_RATE_LIMITS = {'like_post': ('like', 'unlike'), 'comment_post': ('comment',)}
+
+# Global shedding kicks in when too many writes are in flight at once or the
+# recent p99 latency of write requests goes past the threshold.
+LOAD_SHED_MAX_INFLIGHT = 32
+LOAD_SHED_P99_SECONDS = 1.0
+LOAD_SHED_RETRY_AFTER = 2
+LATENCY_WINDOW = 512       # recent write latencies kept for the p99 estimate
+LATENCY_RECOMPUTE_EVERY = 64
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now=None, tokens=1):
+        # Returns 0 when the request may proceed, otherwise seconds to wait.
+        # tokens must not exceed burst, or the wait never ends
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= tokens:
+                bucket[0] -= tokens
+                return 0
+            return (tokens - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+class LoadShedder:
+    def __init__(self, max_inflight=LOAD_SHED_MAX_INFLIGHT, p99_threshold=LOAD_SHED_P99_SECONDS,
+                 window=LATENCY_WINDOW, recompute_every=LATENCY_RECOMPUTE_EVERY):
+        self.max_inflight = max_inflight
+        self.p99_threshold = p99_threshold
+        self.recompute_every = recompute_every
+        self.inflight = 0
+        self.p99 = 0.0
+        self._p99_at = 0.0
+        self._latencies = deque(maxlen=window)
+        self._samples = 0
+        self._lock = threading.Lock()
+
+    def enter(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if self.inflight >= self.max_inflight:
+                return False
+            if self.p99 > self.p99_threshold:
+                # While shedding no new samples arrive, so let traffic probe
+                # again once the cool-down has passed
+                if now - self._p99_at < LOAD_SHED_RETRY_AFTER:
+                    return False
+                self.p99 = 0.0
+                self._latencies.clear()
+            self.inflight += 1
+            return True
+
+    def leave(self, elapsed):
+        with self._lock:
+            self.inflight -= 1
+            self._latencies.append(elapsed)
+            self._samples += 1
+            # Sorting the window is amortised over many requests
+            if self._samples % self.recompute_every == 0:
+                ordered = sorted(self._latencies)
+                self.p99 = ordered[int(len(ordered) * 0.99)]
+                self._p99_at = time.monotonic()
+
+rate_limiters = {}
+for _endpoint, _limits in RATE_LIMITS.items():
+    for _scope in ('user', 'ip'):
+        if _scope in _limits:
+            rate_limiters[(_endpoint, _scope)] = TokenBucketLimiter(*_limits[_scope])
+load_shedder = LoadShedder()
+
+def too_many_requests(retry_after, status=429):
+    retry_after = max(1, math.ceil(retry_after))
+    error = 'Too many requests' if status == 429 else 'Server busy, please retry'
+    response = jsonify({'error': error, 'retry_after': retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def acquire_rate_limits(endpoint, tokens=1):
+    # Charges the endpoint's ip and user buckets for this request; returns 0,
+    # or seconds until it may be retried
+    keys = [('ip', request.remote_addr or 'unknown')]
+    if 'user_id' in session:
+        keys.append(('user', session['user_id']))
+    for scope, key in keys:
+        limiter = rate_limiters.get((endpoint, scope))
+        if limiter is not None:
+            retry_after = limiter.acquire(key, tokens=tokens)
+            if retry_after:
+                return retry_after
+    return 0
+
+def rate_limit_burst(endpoint):
+    return min(limits[1] for scope, limits in RATE_LIMITS[endpoint].items() if scope in ('user', 'ip'))
+
+@app.before_request
+def enforce_rate_limits():
+    limits = RATE_LIMITS.get(request.endpoint)
+    if limits is None or request.method not in limits['methods']:
+        return None
+
+    retry_after = acquire_rate_limits(request.endpoint)
+    if retry_after:
+        return too_many_requests(retry_after)
+
+    if not load_shedder.enter():
+        return too_many_requests(LOAD_SHED_RETRY_AFTER, status=503)
+    g.write_started = time.monotonic()
+    return None
+
+@app.teardown_request
+def release_write_slot(exc):
+    started = g.pop('write_started', None)
+    if started is not None:
+        load_shedder.leave(time.monotonic() - started)
+
+# Profiling
+# Off unless PROFILE_SAMPLE_RATE > 0; when off, each request pays for one
+# attribute check. When on, tracemalloc traces allocations, a sampler thread
+# reads every request thread's stack each PROFILE_INTERVAL and charges the
+# sample to the route and to the innermost frame in this file (plus the leaf
+# function it was in), and PROFILE_SAMPLE_RATE of requests also record their
+# net traced-memory change. Concurrent requests share one heap, so the
+# per-route memory figures are indicative rather than exact. State is per
+# process: query a worker with GET /admin/profile or dump every worker's
+# report to stdout with SIGUSR1 on the master.
+PROFILE_INTERVAL = 0.005         # seconds between CPU samples
+PROFILE_TRACEBACK_FRAMES = 16
+PROFILE_TOP = 15
+APP_SOURCE = os.path.abspath(__file__)
+
+class RequestProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.enabled = False
+        self.sample_rate = 0.0
+        self._active = {}      # thread ident -> endpoint being served
+        self._cpu = {}         # endpoint -> {call site: samples}
+        self._memory = {}      # endpoint -> [sampled requests, total delta, max delta]
+        self._baseline = None  # snapshot from the previous report, for growth
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def configure(self, sample_rate):
+        self.sample_rate = max(0.0, min(float(sample_rate), 1.0))
+        if self.sample_rate > 0 and not self.enabled:
+            tracemalloc.start(PROFILE_TRACEBACK_FRAMES)
+            self.enabled = True
+        elif self.sample_rate == 0 and self.enabled:
+            self.enabled = False
+            tracemalloc.stop()
+            self._baseline = None
+
+    def reset(self):
+        with self._lock:
+            self._cpu.clear()
+            self._memory.clear()
+        self._baseline = None
+
+    def reset_after_fork(self):
+        # The sampler thread does not survive fork; it restarts on first request
+        self._lock = threading.Lock()
+        self._active = {}
+        self._thread = None
+
+    def request_started(self, endpoint):
+        with self._lock:
+            self._active[threading.get_ident()] = endpoint
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+        if random.random() < self.sample_rate:
+            g.profile_traced = tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, endpoint):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        traced = g.pop('profile_traced', None)
+        if traced is not None and tracemalloc.is_tracing():
+            delta = tracemalloc.get_traced_memory()[0] - traced
+            with self._lock:
+                stats = self._memory.setdefault(endpoint, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += delta
+                stats[2] = max(stats[2], delta)
+
+    @staticmethod
+    def call_site(frame):
+        leaf = f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+        while frame is not None and frame.f_code.co_filename != APP_SOURCE:
+            frame = frame.f_back
+        if frame is None:
+            return leaf
+        site = f'{frame.f_code.co_name}:{frame.f_lineno}'
+        return site if leaf.startswith(frame.f_code.co_name + ' ') else f'{site} > {leaf}'
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, endpoint in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        sites = self._cpu.setdefault(endpoint, {})
+                        site = self.call_site(frame)
+                        sites[site] = sites.get(site, 0) + 1
+        with self._lock:
+            self._thread = None
+
+    def report(self, top=PROFILE_TOP):
+        if not self.enabled:
+            return {'enabled': False}
+        with self._lock:
+            cpu = {endpoint: dict(sites) for endpoint, sites in self._cpu.items()}
+            memory = {endpoint: list(stats) for endpoint, stats in self._memory.items()}
+        
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        # Charge each allocation to the innermost frame in this file
+        app_sites = {}
+        for stat in snapshot.statistics('traceback'):
+            frame = next((frame for frame in reversed(stat.traceback) if frame.filename == APP_SOURCE),
+                         stat.traceback[-1])
+            site = app_sites.setdefault(f'{os.path.basename(frame.filename)}:{frame.lineno}', [0, 0])
+            site[0] += stat.size
+            site[1] += stat.count
+        growth = []
+        if self._baseline is not None:
+            growth = [{'site': str(stat.traceback[0]), 'size_diff_bytes': stat.size_diff, 'count_diff': stat.count_diff}
+                      for stat in snapshot.compare_to(self._baseline, 'lineno')[:top] if stat.size_diff]
+        self._baseline = snapshot
+        
+        traced, peak = tracemalloc.get_traced_memory()
+        return {
+            'enabled': True,
+            'pid': os.getpid(),
+            'sample_rate': self.sample_rate,
+            'cpu': {
+                endpoint: {
+                    'samples': sum(sites.values()),
+                    'seconds': round(sum(sites.values()) * self.interval, 3),
+                    'top': [{'site': site, 'samples': samples}
+                            for site, samples in sorted(sites.items(), key=lambda item: -item[1])[:top]],
+                } for endpoint, sites in cpu.items()
+            },
+            'memory': {
+                'traced_bytes': traced,
+                'peak_bytes': peak,
+                'routes': {
+                    endpoint: {'sampled_requests': count, 'avg_delta_bytes': total // count, 'max_delta_bytes': largest}
+                    for endpoint, (count, total, largest) in memory.items()
+                },
+                'top_allocators': [{'site': str(stat.traceback[0]), 'size_bytes': stat.size, 'count': stat.count}
+                                   for stat in snapshot.statistics('lineno')[:top]],
+                'top_app_sites': [{'site': site, 'size_bytes': size, 'count': count}
+                                  for site, (size, count) in sorted(app_sites.items(), key=lambda item: -item[1][0])[:top]],
+                'growth_since_last_report': growth,
+            },
+        }
+
+    def dump(self, signum=None, frame=None):
+        report = self.report()
+        if not report['enabled']:
+            print(f"🔬 [{os.getpid()}] Profiling is off (set INSTACLONE_PROFILE_SAMPLE_RATE)")
+            return
+        lines = [f"🔬 Profile for worker {report['pid']} (traced {report['memory']['traced_bytes']:,} bytes, "
+                 f"peak {report['memory']['peak_bytes']:,})"]
+        for endpoint, cpu in sorted(report['cpu'].items(), key=lambda item: -item[1]['samples']):
+            lines.append(f"   CPU {endpoint}: ~{cpu['seconds']}s")
+            lines.extend(f"      {entry['samples']:>6}  {entry['site']}" for entry in cpu['top'][:5])
+        for endpoint, stats in report['memory']['routes'].items():
+            lines.append(f"   MEM {endpoint}: avg {stats['avg_delta_bytes']:+,} bytes/request "
+                         f"(max {stats['max_delta_bytes']:+,}, {stats['sampled_requests']} sampled)")
+        lines.append("   Top allocation sites:")
+        lines.extend(f"      {entry['size_bytes']:>12,}  {entry['site']}" for entry in report['memory']['top_app_sites'])
+        print('\n'.join(lines), flush=True)
+
+profiler = RequestProfiler()
+os.register_at_fork(after_in_child=profiler.reset_after_fork)
+
+@app.before_request
+def start_request_profile():
+    if profiler.enabled:
+        profiler.request_started(request.endpoint)
 
-def get_comments(post_id):
-    try:
-        conn = sqlite3.connect('instagram_clone.db')
-        c = conn.cursor()
-        c.execute('''SELECT c.comment, c.created_at, u.username 
-                     FROM comments c
-                     JOIN users u ON c.user_id = u.id
-                     WHERE c.post_id = ?
-                     ORDER BY c.created_at ASC''', (post_id,))
-        comments = c.fetchall()
-        conn.close()
-        return comments
-    except Exception as e:
-        print(f"Error getting comments: {e}")
-        return []
+@app.teardown_request
+def finish_request_profile(exc):
+    if profiler.enabled:
+        profiler.request_finished(request.endpoint)
 
-def is_liked_by_user(user_id, post_id):
-    try:
-        conn = sqlite3.connect('instagram_clone.db')
-        c = conn.cursor()
-        c.execute('SELECT id FROM likes WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-        result = c.fetchone()
-        conn.close()
-        return result is not None
-    except Exception as e:
-        print(f"Error checking like status: {e}")
-        return False
+def is_admin():
+    admins = {name.strip() for name in str(app.config['ADMIN_USERNAMES']).split(',') if name.strip()}
+    return session.get('username') in admins
 
 # Main Template
 MAIN_TEMPLATE = '''
@@ -318,6 +3011,18 @@ MAIN_TEMPLATE = '''
             box-shadow: 0 4px 20px rgba(0,0,0,0.1);
         }
         
+        .feed-sort {
+            text-align: right;
+            margin-bottom: 12px;
+            font-size: 14px;
+            color: #8e8e8e;
+        }
+        
+        .feed-sort a {
+            color: #0095f6;
+            text-decoration: none;
+        }
+        
         .post-header {
             padding: 14px 16px;
             display: flex;
@@ -339,6 +3044,14 @@ MAIN_TEMPLATE = '''
             color: #667eea;
         }
         
+        .post-header .btn-delete {
+            margin-left: auto;
+            background: none;
+            border: none;
+            cursor: pointer;
+            font-size: 18px;
+        }
+        
         .post-header .username {
             font-weight: 600;
             font-size: 16px;
@@ -346,9 +3059,49 @@ MAIN_TEMPLATE = '''
         
         .post-image {
             width: 100%;
+            height: auto;
             max-height: 600px;
             object-fit: cover;
             display: block;
+            background-color: #efefef;
+            background-size: cover;
+            background-position: center;
+        }
+        
+        .carousel {
+            position: relative;
+        }
+        
+        .carousel-prev, .carousel-next {
+            position: absolute;
+            top: 50%;
+            transform: translateY(-50%);
+            width: 30px;
+            height: 30px;
+            border: none;
+            border-radius: 50%;
+            background: rgba(255, 255, 255, 0.8);
+            cursor: pointer;
+            font-size: 18px;
+        }
+        
+        .carousel-prev {
+            left: 8px;
+        }
+        
+        .carousel-next {
+            right: 8px;
+        }
+        
+        .carousel-counter {
+            position: absolute;
+            top: 12px;
+            right: 12px;
+            padding: 2px 8px;
+            border-radius: 12px;
+            background: rgba(0, 0, 0, 0.6);
+            color: white;
+            font-size: 12px;
         }
         
         .post-actions {
@@ -751,6 +3504,52 @@ MAIN_TEMPLATE = '''
             .catch(error => console.error('Error:', error));
         }
         
+        function deletePost(postId) {
+            if (!confirm('Delete this post?')) return;
+            
+            fetch('/posts/' + postId + '/delete', {method: 'POST'})
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    document.querySelector(`[data-post-id="${postId}"]`).remove();
+                }
+            })
+            .catch(error => console.error('Error:', error));
+        }
+        
+        // Carousel - the slides after the cover are only fetched on first use
+        const carouselMedia = {};
+        
+        function stepCarousel(postId, step) {
+            const carousel = document.querySelector(`[data-post-id="${postId}"] .carousel`);
+            if (!carouselMedia[postId]) {
+                const partition = carousel.dataset.partition ? '?partition=' + carousel.dataset.partition : '';
+                carouselMedia[postId] = fetch('/api/posts/' + postId + '/media' + partition)
+                    .then(response => response.json())
+                    .then(data => data.media);
+            }
+            
+            carouselMedia[postId].then(media => {
+                if (!media || media.length < 2) return;
+                const index = (Number(carousel.dataset.index) + step + media.length) % media.length;
+                const image = carousel.querySelector('.post-image');
+                const item = media[index];
+                
+                image.style.backgroundImage = item.placeholder ? `url(${item.placeholder})` : '';
+                if (item.width && item.height) {
+                    image.width = item.width;
+                    image.height = item.height;
+                }
+                image.src = item.src;
+                carousel.dataset.index = index;
+                carousel.querySelector('.carousel-counter').textContent = (index + 1) + '/' + media.length;
+                
+                // Warm the next slide in the direction of travel
+                new Image().src = media[(index + step + media.length) % media.length].src;
+            })
+            .catch(error => console.error('Error:', error));
+        }
+        
         // Enter key for comments
         document.addEventListener('keypress', function(e) {
             if (e.target.classList.contains('comment-input') && e.key === 'Enter') {
@@ -764,95 +3563,121 @@ MAIN_TEMPLATE = '''
 '''
 
 # Routes
-@app.route('/')
-def home():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+def render_shell(template):
+    # Resolve the template's nav links once; the content slot splits the page
+    # into a head and tail that the streamed feed writes around its posts
+    page = template.replace('{{ url_for(\'home\') }}', '/').replace('{{ url_for(\'upload\') }}', '/upload').replace('{{ url_for(\'logout\') }}', '/logout')
+    page = page.replace('{% if session.username %}', '').replace('{% endif %}', '')
+    return page.split('{{ content|safe }}')
+
+FEED_SHELL_HEAD, FEED_SHELL_TAIL = render_shell(MAIN_TEMPLATE)
+
+def render_feed_post(post, eager=False, is_liked=None):
+    image_html = carousel_html(post, post_image_html(media_url(post.media_hash, post.image_data), post.image_width,
+                                                     post.image_height, post.placeholder, eager=eager))
+    if is_liked is None:
+        is_liked = is_liked_by_user(session['user_id'], post.id, post.partition)
+    like_icon = "❤️" if is_liked else "🤍"
+    like_class = "liked" if is_liked else ""
     
-    posts = get_posts_for_feed()
-    
-    # Process posts and add like status
-    processed_posts = []
-    for post in posts:
-        post_data = {
-            'id': post[0],
-            'image_data': post[1],
-            'caption': post[2],
-            'created_at': post[3],
-            'username': post[4],
-            'like_count': post[5],
-            'comment_count': post[6],
-            'is_liked': is_liked_by_user(session['user_id'], post[0]),
-            'comments': get_comments(post[0])[:3]  # Show first 3 comments
-        }
-        processed_posts.append(post_data)
-    
-    # Flash messages
-    messages_html = ""
-    messages = session.pop('_flashes', []) if '_flashes' in session else []
-    for category, message in messages:
-        alert_class = 'alert-success' if category == 'message' else 'alert-error'
-        messages_html += f'<div class="alert {alert_class}">{message}</div>'
-    
-    if not processed_posts:
-        content = f'''
-        {messages_html}
-        <div class="container">
-            <div class="empty-state">
-                <h3>Welcome to InstaClone! 🎉</h3>
-                <p>No posts yet. Be the first to share something amazing!</p>
-                <a href="{url_for('upload')}">📸 Upload your first photo</a>
-            </div>
-        </div>
-        '''
-    else:
-        posts_html = ""
-        for post in processed_posts:
-            like_icon = "❤️" if post['is_liked'] else "🤍"
-            like_class = "liked" if post['is_liked'] else ""
-            
-            comments_html = ""
-            for comment in post['comments']:
-                comments_html += f'<div class="comment"><span class="username">{comment[2]}</span>{comment[0]}</div>'
-            
-            posts_html += f'''
-            <article class="post" data-post-id="{post['id']}">
+    comments_html = ''.join(
+        f'<div class="comment"><span class="username">{comment.username}</span>{comment.comment}</div>'
+        for comment in get_comments(post.id, limit=3, partition=post.partition)  # Show first 3 comments
+    )
+    
+    can_delete = not post.partition and post.username == session.get('username')
+    
+    # Archived posts are read-only
+    comment_form_html = '' if post.partition else f'''<form class="comment-form" onsubmit="event.preventDefault(); submitComment({post.id})">
+                        <input type="text" class="comment-input" placeholder="Add a comment...">
+                        <button type="submit" class="comment-submit">Post</button>
+                    </form>'''
+    
+    return f'''
+            <article class="post" data-post-id="{post.id}">
                 <header class="post-header">
-                    <div class="avatar">{post['username'][0].upper()}</div>
-                    <span class="username">{post['username']}</span>
+                    <div class="avatar">{post.username[0].upper()}</div>
+                    <span class="username">{post.username}</span>
+                    {f'<button class="btn-delete" title="Delete post" onclick="deletePost({post.id})">🗑️</button>' if can_delete else ''}
                 </header>
                 
-                <img src="data:image/jpeg;base64,{post['image_data']}" alt="Post image" class="post-image">
+                {image_html}
                 
                 <div class="post-actions">
-                    <button class="btn-like {like_class}" onclick="toggleLike({post['id']})">{like_icon}</button>
-                    <button class="btn-comment" onclick="document.querySelector('[data-post-id=\\'{post['id']}\\'] .comment-input').focus()">💬</button>
+                    <button class="btn-like {like_class}" onclick="toggleLike({post.id})">{like_icon}</button>
+                    <button class="btn-comment" onclick="document.querySelector('[data-post-id=\\'{post.id}\\'] .comment-input').focus()">💬</button>
                 </div>
                 
                 <div class="post-info">
-                    <div class="like-count">{post['like_count']} likes</div>
-                    {f'<div class="post-caption"><span class="username">{post["username"]}</span>{post["caption"]}</div>' if post['caption'] else ''}
-                    <div class="post-time">{post['created_at']}</div>
+                    <div class="like-count">{post.like_count} likes</div>
+                    {f'<div class="post-caption"><span class="username">{post.username}</span>{post.caption}</div>' if post.caption else ''}
+                    <div class="post-time">{post.created_at}</div>
                 </div>
                 
                 <div class="comments-section">
                     <div class="comments">{comments_html}</div>
-                    <form class="comment-form" onsubmit="event.preventDefault(); submitComment({post['id']})">
-                        <input type="text" class="comment-input" placeholder="Add a comment...">
-                        <button type="submit" class="comment-submit">Post</button>
-                    </form>
+                    {comment_form_html}
                 </div>
             </article>
             '''
-        
-        content = f'''
+
+@app.route('/')
+def home():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    ordering = request.args.get('sort', 'recent')
+    if ordering not in FEED_ORDERINGS:
+        ordering = 'recent'
+    before_id = request.args.get('before_id', type=int)
+    before = (request.args['before'], before_id) if 'before' in request.args and before_id else None
+    
+    # Flash messages - popped before streaming starts, since the session
+    # cookie goes out with the headers on the first chunk
+    messages_html = render_flash_messages()
+    
+    sort_links = ' · '.join(
+        f'<strong>{label}</strong>' if key == ordering else f'<a href="/?sort={key}">{label}</a>'
+        for key, label in (('recent', 'Latest'), ('top', 'Top'))
+    )
+    
+    # The shell head goes out before any database work, then one article per
+    # post, so time to first byte and peak memory don't grow with the page
+    def generate():
+        yield FEED_SHELL_HEAD
+        yield f'''
         {messages_html}
         <div class="container">
-            {posts_html}
+            <div class="feed-sort">{sort_links}</div>
+        '''
+        
+        posts = get_posts_for_feed(FEED_PAGE_SIZE, ordering, before)
+        if not posts and before is None:
+            yield f'''
+            <div class="empty-state">
+                <h3>Welcome to InstaClone! 🎉</h3>
+                <p>No posts yet. Be the first to share something amazing!</p>
+                <a href="{url_for('upload')}">📸 Upload your first photo</a>
+            </div>
+            '''
+        # Archived posts (rare, deep pages) fall back to a lookup per post
+        liked = like_index.liked_posts(session['user_id'], [post.id for post in posts if not post.partition])
+        for index, post in enumerate(posts):
+            yield render_feed_post(post, eager=index == 0,
+                                   is_liked=None if post.partition else post.id in liked)
+        
+        if ordering == 'recent' and len(posts) == FEED_PAGE_SIZE:
+            last = posts[-1]
+            yield f'<div class="feed-sort"><a href="{url_for("home", before=last.created_at, before_id=last.id)}">Older posts →</a></div>'
+        
+        yield '''
         </div>
         '''
+        yield FEED_SHELL_TAIL
     
-    return MAIN_TEMPLATE.replace('{{ content|safe }}', content).replace('{{ url_for(\'home\') }}', '/').replace('{{ url_for(\'upload\') }}', '/upload').replace('{{ url_for(\'logout\') }}', '/logout')
+    response = Response(stream_with_context(generate()), mimetype='text/html')
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a proxy re-buffer the stream
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -861,20 +3686,16 @@ def login():
         password = request.form['password']
         
         user = get_user_by_username(username)
-        if user and check_password_hash(user[3], password):
-            session['user_id'] = user[0]
-            session['username'] = user[1]
+        if user and check_password_hash(user.password, password):
+            session.regenerate()
+            session['user_id'] = user.id
+            session['username'] = user.username
             flash('Welcome back!', 'message')
             return redirect(url_for('home'))
         else:
             flash('Invalid username or password')
     
-    # Flash messages
-    messages_html = ""
-    messages = session.pop('_flashes', []) if '_flashes' in session else []
-    for category, message in messages:
-        alert_class = 'alert-success' if category == 'message' else 'alert-error'
-        messages_html += f'<div class="alert {alert_class}">{message}</div>'
+    messages_html = render_flash_messages()
     
     content = f'''
     <div class="login-container">
@@ -926,12 +3747,7 @@ def register():
         else:
             flash('Username or email already exists')
     
-    # Flash messages
-    messages_html = ""
-    messages = session.pop('_flashes', []) if '_flashes' in session else []
-    for category, message in messages:
-        alert_class = 'alert-success' if category == 'message' else 'alert-error'
-        messages_html += f'<div class="alert {alert_class}">{message}</div>'
+    messages_html = render_flash_messages()
     
     content = f'''
     <div class="login-container">
@@ -971,32 +3787,25 @@ def upload():
         return redirect(url_for('login'))
     
     if request.method == 'POST':
-        if 'file' not in request.files:
-            flash('No file selected')
-            return redirect(request.url)
-        
-        file = request.files['file']
-        if file.filename == '':
+        files = [file for file in request.files.getlist('file') if file.filename]
+        if not files:
             flash('No file selected')
             return redirect(request.url)
         
-        if file and allowed_file(file.filename):
-            # Convert image to base64
-            image_data = base64.b64encode(file.read()).decode('utf-8')
+        if len(files) > CAROUSEL_MAX_ITEMS:
+            flash(f'You can share up to {CAROUSEL_MAX_ITEMS} photos in one post')
+        elif all(allowed_file(file.filename) for file in files):
+            images = [file.read() for file in files]
             caption = request.form.get('caption', '')
             
-            create_post(session['user_id'], image_data, caption)
-            flash('Photo uploaded successfully! 📸', 'message')
+            create_post(session['user_id'], images, caption)
+            flash('Photo uploaded successfully! 📸' if len(images) == 1 else f'{len(images)} photos uploaded successfully! 📸',
+                  'message')
             return redirect(url_for('home'))
         else:
             flash('Invalid file type. Please upload an image (PNG, JPG, JPEG, GIF)')
     
-    # Flash messages
-    messages_html = ""
-    messages = session.pop('_flashes', []) if '_flashes' in session else []
-    for category, message in messages:
-        alert_class = 'alert-success' if category == 'message' else 'alert-error'
-        messages_html += f'<div class="alert {alert_class}">{message}</div>'
+    messages_html = render_flash_messages()
     
     content = f'''
     <div class="container">
@@ -1008,8 +3817,8 @@ def upload():
             <form method="POST" enctype="multipart/form-data">
                 <div class="form-group" style="text-align: center;">
                     <label class="file-input-wrapper">
-                        <input type="file" name="file" accept="image/*" required>
-                        📷 Choose Photo
+                        <input type="file" name="file" accept="image/*" multiple required>
+                        📷 Choose Photos
                     </label>
                 </div>
                 
@@ -1028,6 +3837,68 @@ def upload():
     
     return MAIN_TEMPLATE.replace('{{ content|safe }}', content).replace('{{ url_for(\'home\') }}', '/').replace('{{ url_for(\'upload\') }}', '/upload').replace('{{ url_for(\'logout\') }}', '/logout')
 
+def upload_error_response(error):
+    return jsonify({'error': str(error), **error.details}), error.status
+
+@app.route('/api/uploads', methods=['POST'])
+def upload_sessions_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    try:
+        session_id = create_upload_session(session['user_id'], str(data.get('filename', '')), data.get('size'),
+                                           str(data.get('sha256', '')), str(data.get('caption', '')))
+    except UploadError as e:
+        return upload_error_response(e)
+    response = jsonify({'id': session_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_MAX_BYTES})
+    response.status_code = 201
+    response.headers['Location'] = url_for('upload_session_api', session_id=session_id)
+    return response
+
+@app.route('/api/uploads/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_session_api(session_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        if request.method == 'DELETE':
+            if not delete_upload_session(session_id, session['user_id']):
+                raise UploadError('Upload session not found', 404)
+            return jsonify({'success': True})
+        if request.method == 'PUT':
+            offset = request.headers.get('Upload-Offset', type=int)
+            if offset is None:
+                raise UploadError('Upload-Offset header is required')
+            received = append_upload_chunk(session_id, session['user_id'], offset, request.stream,
+                                           request.content_length)
+            upload_session = get_upload_session(session_id, session['user_id'])
+        else:
+            upload_session = get_upload_session(session_id, session['user_id'])
+            received = os.path.getsize(upload_part_path(session_id))
+    except UploadError as e:
+        return upload_error_response(e)
+    
+    return jsonify({
+        'id': session_id,
+        'offset': received,
+        'size': upload_session.total_size,
+        'complete': received == upload_session.total_size,
+    })
+
+@app.route('/api/uploads/<session_id>/finalize', methods=['POST'])
+def finalize_upload_api(session_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        finalize_upload(session_id, session['user_id'])
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'success': True})
+
 @app.route('/like/<int:post_id>', methods=['POST'])
 def like_post(post_id):
     if 'user_id' not in session:
@@ -1037,10 +3908,11 @@ def like_post(post_id):
         liked = toggle_like(session['user_id'], post_id)
         
         # Get updated like count
-        conn = sqlite3.connect('instagram_clone.db')
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM likes WHERE post_id = ?', (post_id,))
-        like_count = c.fetchone()[0]
+        c.execute('SELECT like_count FROM posts WHERE id = ?', (post_id,))
+        result = c.fetchone()
+        like_count = result[0] if result else 0
         conn.close()
         
         return jsonify({'liked': liked, 'like_count': like_count})
@@ -1065,15 +3937,608 @@ def comment_post(post_id):
         print(f"Error in comment_post: {e}")
         return jsonify({'error': 'Database error'}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations or not all(isinstance(op, dict) for op in operations):
+        return jsonify({'error': 'Expected a non-empty list of operations'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'At most {BATCH_MAX_OPERATIONS} operations per batch'}), 400
+    for operation in operations:
+        key = operation.get('key')
+        if key is not None and (not isinstance(key, str) or not 0 < len(key) <= BATCH_KEY_MAX_LENGTH):
+            return jsonify({'error': 'Invalid idempotency key'}), 400
+    
+    # One batch request must not buy more likes or comments than the same
+    # operations sent one by one would
+    for endpoint, ops in BATCH_RATE_LIMITS.items():
+        cost = sum(1 for operation in operations if operation.get('op') in ops)
+        if cost > rate_limit_burst(endpoint):
+            return jsonify({'error': f'At most {rate_limit_burst(endpoint)} {"/".join(ops)} operations per batch'}), 400
+        retry_after = cost and acquire_rate_limits(endpoint, cost)
+        if retry_after:
+            return too_many_requests(retry_after)
+    
+    try:
+        results = apply_batch(session['user_id'], operations)
+    except Exception as e:
+        print(f"Error in api_batch: {e}")
+        return jsonify({'error': 'Database error'}), 500
+    return jsonify({'results': results})
+
+@app.route('/media/<media_hash>')
+def media(media_hash):
+    if not is_media_hash(media_hash):
+        abort(404)
+    blob = get_media_blob(media_hash)
+    if blob is None or not os.path.exists(media_path(media_hash)):
+        abort(404)
+    
+    # Content-addressed, so the bytes behind a URL never change
+    response = send_file(media_path(media_hash), mimetype=blob[1], etag=media_hash,
+                         max_age=31536000, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/posts/<int:post_id>/media')
+def post_media(post_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    media = get_post_media(post_id, request.args.get('partition'))
+    if not media:
+        return jsonify({'error': 'Post not found'}), 404
+    response = jsonify({'post_id': post_id, 'media': [
+        {'position': item.position, 'src': media_url(item.media_hash), 'width': item.width,
+         'height': item.height, 'placeholder': item.placeholder}
+        for item in media
+    ]})
+    response.cache_control.private = True
+    response.cache_control.max_age = 300  # a post's images never change, only whether it still exists
+    return response
+
+@app.route('/api/posts/<int:post_id>/similar')
+def similar_posts(post_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    max_distance = min(max(request.args.get('distance', SIMILAR_MEDIA_MAX_DISTANCE, type=int), 0), 32)
+    similar = find_similar_posts(post_id, max_distance)
+    return jsonify({'post_id': post_id, 'similar': [
+        {'post_id': similar_id, 'distance': distance, 'username': username, 'image_src': media_url(media_hash)}
+        for distance, similar_id, media_hash, username in similar
+    ]})
+
+@app.route('/api/notifications')
+def notifications_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', NOTIFICATIONS_PER_PAGE, type=int), 1), 100)
+    rows = get_notifications(session['user_id'], page, per_page)
+
+    notifications = []
+    for notification in rows[:per_page]:
+        notifications.append({
+            'id': notification.id,
+            'post_id': notification.post_id,
+            'verb': notification.verb,
+            'actor_count': notification.actor_count,
+            'last_actor': notification.last_actor,
+            'text': format_notification(notification.verb, notification.actor_count, notification.last_actor),
+            'is_read': bool(notification.is_read),
+            'updated_at': notification.updated_at
+        })
+
+    return jsonify({
+        'notifications': notifications,
+        'unread_count': get_unread_notification_count(session['user_id']),
+        'page': page,
+        'has_more': len(rows) > per_page
+    })
+
+@app.route('/api/trending')
+def trending_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    kind = request.args.get('kind', 'posts')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    if kind == 'tags':
+        return jsonify({'tags': [{'tag': tag, 'score': score} for tag, score in trending.top('tag', limit)]})
+    if kind != 'posts':
+        return jsonify({'error': 'kind must be posts or tags'}), 400
+    
+    return jsonify({'posts': [{
+        'id': post.id,
+        'username': post.username,
+        'caption': post.caption,
+        'image_url': media_url(post.media_hash, post.image_data),
+        'like_count': post.like_count,
+        'comment_count': post.comment_count,
+        'score': score,
+    } for post, score in get_trending_posts(limit)]})
+
+@app.route('/api/notifications/read', methods=['POST'])
+def notifications_read():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    if mark_notifications_read(session['user_id']):
+        return jsonify({'success': True, 'unread_count': 0})
+    return jsonify({'error': 'Database error'}), 500
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    # POST {"sample_rate": 0.1} turns profiling on (0 turns it off) and
+    # {"reset": true} clears the counters - for the worker that handles it
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'sample_rate' in data:
+            try:
+                profiler.configure(data['sample_rate'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'sample_rate must be a number between 0 and 1'}), 400
+        if data.get('reset'):
+            profiler.reset()
+    return jsonify(profiler.report(min(max(request.args.get('top', PROFILE_TOP, type=int), 1), 100)))
+
+@app.route('/posts/<int:post_id>/delete', methods=['POST'])
+def delete_post_route(post_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    if not delete_post(session['user_id'], post_id):
+        return jsonify({'error': 'Post not found'}), 404
+    return jsonify({'success': True})
+
+@app.route('/account/delete', methods=['POST'])
+def delete_account_route():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    user = get_user_by_username(session['username'])
+    if not user or not check_password_hash(user.password, request.form.get('password', '')):
+        flash('Incorrect password - your account was not deleted')
+        return redirect(url_for('home'))
+    delete_account(user.id)
+    session.clear()
+    session.regenerate()
+    flash('Your account has been deleted. 👋', 'message')
+    return redirect(url_for('login'))
+
+@app.route('/api/sessions/revoke', methods=['POST'])
+def revoke_sessions_api():
+    # "Sign out everywhere else"
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify({'revoked': session_store.revoke_user(session['user_id'], keep_sid=session.sid)})
+
 @app.route('/logout')
 def logout():
     session.clear()
+    session.regenerate()
     flash('You have been logged out successfully! 👋', 'message')
     return redirect(url_for('login'))
 
+# Application factory and production server
+# `serve` preloads the app in the master (config, pending migrations), then
+# forks workers that share one listening socket and each run a bounded
+# thread pool. SIGTERM stops accepting, drains in-flight requests and exits.
+SERVER_DEFAULTS = {
+    'HOST': '127.0.0.1',
+    'PORT': 8000,
+    'WORKERS': 2,
+    'THREADS': 8,
+    'GRACEFUL_TIMEOUT': 30,
+}
+
+def create_app(config=None):
+    app.config.update(load_config_from_env())
+    if config:
+        app.config.update(config)
+    profiler.configure(app.config['PROFILE_SAMPLE_RATE'])
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    if migrations_pending():
+        apply_migrations()
+    return app
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, *args, threads=SERVER_DEFAULTS['THREADS'], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http-worker')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._handle_request, request, client_address)
+
+    def _handle_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def drain(self):
+        # Workers leave through os._exit, so atexit hooks never run here
+        self.executor.shutdown(wait=True)
+        notification_buffer.flush()
+        trending.snapshot()
+        self.server_close()
+
+def serve_worker(wsgi_app, host, port, fd, threads):
+    server = PooledWSGIServer(host, port, wsgi_app, fd=fd, threads=threads)
+
+    def handle_stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off-thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGUSR1, profiler.dump)
+    server.serve_forever()
+    server.drain()
+
+# Housekeeping run every MAINTENANCE_INTERVAL by a dedicated `serve` process;
+# each task works in small batches
+MAINTENANCE_TASKS = (archive_old_posts, purge_deleted_content, collect_media_garbage, incremental_vacuum,
+                     sweep_idle_sessions, gc_upload_sessions)
+
+def run_maintenance(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        for task in MAINTENANCE_TASKS:
+            try:
+                result = task()
+                if result:
+                    print(f"🧹 {task.__name__}: {result}")
+            except Exception as e:
+                print(f"Error in {task.__name__}: {e}")
+        stop_event.wait(float(app.config['MAINTENANCE_INTERVAL']))
+
+def serve_maintenance():
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    run_maintenance(stop_event)
+
+def run_server(host, port, workers, threads, graceful_timeout):
+    wsgi_app = create_app()
+    listener = socket.create_server((host, port), backlog=128)
+    listener.set_inheritable(True)
+    print(f"🌐 Serving on http://{host}:{port} ({workers} workers x {threads} threads)")
+
+    if workers <= 0:
+        serve_worker(wsgi_app, host, port, listener.fileno(), threads)
+        return
+
+    children = {}  # pid -> role
+    stopping = False
+    kill_at = None
+
+    def spawn(role='worker'):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if role == 'maintenance':
+                    serve_maintenance()
+                else:
+                    serve_worker(wsgi_app, host, port, listener.fileno(), threads)
+            finally:
+                os._exit(0)
+        children[pid] = role
+
+    def handle_stop(signum, frame):
+        nonlocal stopping, kill_at
+        if not stopping:
+            stopping = True
+            kill_at = time.monotonic() + graceful_timeout
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    def handle_dump(signum, frame):
+        for pid, role in children.items():
+            if role == 'worker':
+                os.kill(pid, signal.SIGUSR1)
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGUSR1, handle_dump)
+    for _ in range(workers):
+        spawn()
+    # Housekeeping runs in its own process so batch jobs never compete with
+    # request threads for the GIL
+    spawn('maintenance')
+
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() > kill_at:
+                for child in children:
+                    os.kill(child, signal.SIGKILL)
+                kill_at = float('inf')
+            time.sleep(0.2)
+            continue
+        role = children.pop(pid)
+        if not stopping:
+            print(f"⚠️ {role.capitalize()} {pid} exited with status {status}, respawning")
+            spawn(role)
+    listener.close()
+
+# Benchmarks
+@contextlib.contextmanager
+def benchmark_database(post_count):
+    # Seeds a throwaway database with a month of posts and skewed likes; yields
+    # the number of likes written
+    import tempfile
+    
+    saved_config = {key: app.config[key] for key in ('DATABASE', 'UPLOAD_FOLDER')}
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        app.config['UPLOAD_FOLDER'] = os.path.join(tmp, 'uploads')
+        try:
+            apply_migrations()
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.executemany('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                          [(f'bench{i}', f'bench{i}@example.com', '-') for i in range(200)])
+            now = time.time()
+            c.executemany("INSERT INTO posts (user_id, image_data, caption, created_at) VALUES (?, '', ?, datetime(?, 'unixepoch'))",
+                          [(random.randint(1, 200), f'post {i}', now - random.uniform(0, 30 * 86400))
+                           for i in range(post_count)])
+            likes = []
+            for post_id in range(1, post_count + 1):
+                for user_id in random.sample(range(1, 201), min(200, int(random.paretovariate(1.2)))):
+                    likes.append((user_id, post_id))
+            c.executemany('INSERT INTO likes (user_id, post_id) VALUES (?, ?)', likes)
+            c.execute('UPDATE posts SET like_count = (SELECT COUNT(*) FROM likes WHERE post_id = posts.id)')
+            conn.commit()
+            conn.close()
+            recompute_rank_scores()
+            yield len(likes)
+        finally:
+            app.config.update(saved_config)
+
+def benchmark_feed(post_count=10000, iterations=200, page_size=20):
+    # Times chronological vs ranked feed pages
+    import statistics
+    
+    with benchmark_database(post_count) as like_count:
+        results = {}
+        for ordering in FEED_ORDERINGS:
+            get_posts_for_feed(page_size, ordering)  # warm the page cache
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                get_posts_for_feed(page_size, ordering)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[ordering] = {
+                'median_ms': statistics.median(timings),
+                'p95_ms': timings[int(len(timings) * 0.95)],
+            }
+        return {'posts': post_count, 'likes': like_count, 'results': results}
+
+def benchmark_row_memory(post_count=10000):
+    # Bytes held per exported post: raw tuples, the per-post dicts home() used
+    # to build, and the __slots__ Post model
+    import gc
+    
+    def measure(load):
+        # Measured as growth in traced memory, leaving tracing alone if the
+        # profiler already has it running in this process
+        gc.collect()
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        rows = load()
+        held = tracemalloc.get_traced_memory()[0] - before
+        if started:
+            tracemalloc.stop()
+        return held / max(len(rows), 1)
+    
+    def load_tuples():
+        conn = get_db_connection()
+        rows = conn.execute(f'SELECT {", ".join(FEED_POST_COLUMNS)} FROM posts p JOIN users u ON p.user_id = u.id '
+                            'LEFT JOIN media_blobs m ON m.sha256 = p.media_hash').fetchall()
+        conn.close()
+        return rows
+    
+    def load_dicts():
+        return [dict(zip(Post.__slots__, row)) for row in load_tuples()]
+    
+    with benchmark_database(post_count):
+        results = {
+            'tuple': measure(load_tuples),
+            'dict': measure(load_dicts),
+            'slots': measure(lambda: get_posts_for_feed(post_count)),
+        }
+    return {'posts': post_count, 'bytes_per_row': results}
+
+def benchmark_session_bytes(page_views=20):
+    # Session bytes on the wire per request (Cookie request header plus any
+    # Set-Cookie response headers) for a login / browse / failed upload /
+    # logout flow, with signed cookies vs the server-side store
+    from flask.sessions import SecureCookieSession, SecureCookieSessionInterface
+    
+    class CookieSession(SecureCookieSession):
+        def regenerate(self):
+            pass  # signed cookies have no id to rotate
+    
+    class CookieSessionInterface(SecureCookieSessionInterface):
+        session_class = CookieSession
+    
+    def run_flow():
+        client = app.test_client()
+        totals = {'requests': 0, 'cookie_bytes': 0, 'set_cookie_bytes': 0, 'set_cookie_responses': 0}
+        
+        def call(method, path, **kwargs):
+            cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+            if cookie is not None:
+                totals['cookie_bytes'] += len(f'{cookie.key}={cookie.value}')
+            response = client.open(path, method=method, **kwargs)
+            response.get_data()
+            set_cookies = response.headers.getlist('Set-Cookie')
+            totals['requests'] += 1
+            totals['set_cookie_bytes'] += sum(len(header) for header in set_cookies)
+            totals['set_cookie_responses'] += bool(set_cookies)
+        
+        call('POST', '/login', data={'username': 'demo_user', 'password': 'demo123'})
+        for i in range(page_views):
+            call('GET', '/')
+            if i % 10 == 0:  # stays within the upload rate limit across both runs
+                call('POST', '/upload', data={})  # flashes "No file selected"
+                call('GET', '/upload')
+        call('GET', '/logout')
+        call('GET', '/login')
+        totals['bytes_per_request'] = (totals['cookie_bytes'] + totals['set_cookie_bytes']) / totals['requests']
+        return totals
+    
+    saved_interface = app.session_interface
+    with benchmark_database(100):
+        try:
+            results = {}
+            for name, interface in (('cookie', CookieSessionInterface()), ('server', SqliteSessionInterface())):
+                app.session_interface = interface
+                results[name] = run_flow()
+        finally:
+            app.session_interface = saved_interface
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='InstaClone server')
+    parser.add_argument('command', nargs='?', default='dev',
+                        choices=['dev', 'serve', 'init-db', 'dedup-report', 'rescore', 'archive', 'backup', 'export', 'import', 'gc-uploads',
+                                 'purge-deleted', 'vacuum',
+                                 'bench-feed', 'bench-rows', 'bench-sessions'],
+                        help='dev: debug server, serve: production server, init-db: reset the database, '
+                             'dedup-report: storage saved by media deduplication, '
+                             'rescore: recompute feed rank scores, archive: move old posts to monthly archives, '
+                             'backup: online copy of the databases to --path, '
+                             'export/import: NDJSON dump with media files to/from --path, '
+                             'gc-uploads: remove abandoned resumable uploads, '
+                             'purge-deleted: clean up deleted posts/accounts and unreferenced media now, '
+                             'vacuum: full VACUUM, switching to incremental auto-vacuum, '
+                             'bench-feed: ranked vs chronological feed latency, '
+                             'bench-rows: memory per exported post row, '
+                             'bench-sessions: session bytes per request, cookie vs server-side')
+    parser.add_argument('--path', help='backup/export destination or import source directory')
+    parser.add_argument('--posts', type=int, default=10000, help='posts to seed for benchmarks')
+    parser.add_argument('--iterations', type=int, default=200, help='timed runs per benchmark')
+    for key, default in SERVER_DEFAULTS.items():
+        parser.add_argument('--' + key.lower().replace('_', '-'), type=type(default),
+                            default=type(default)(os.environ.get(CONFIG_ENV_PREFIX + key, default)))
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
-    init_db()
+    args = parse_args()
+
+    if args.command == 'init-db':
+        init_db()
+        sys.exit(0)
+
+    if args.command == 'dedup-report':
+        create_app()
+        report = get_dedup_report()
+        print(f"📦 {report['blobs']} stored images referenced by {report['references']} posts")
+        print(f"   Stored:  {report['stored_bytes']:,} bytes")
+        print(f"   Logical: {report['logical_bytes']:,} bytes")
+        print(f"   Saved:   {report['saved_bytes']:,} bytes ({report['saved_ratio']:.1%})")
+        sys.exit(0)
+    
+    if args.command == 'rescore':
+        create_app()
+        print(f"✅ Rescored {recompute_rank_scores()} posts (half-life {app.config['RANK_HALF_LIFE_HOURS']}h)")
+        sys.exit(0)
+    
+    if args.command == 'archive':
+        create_app()
+        moved = archive_old_posts()
+        print(f"🗄️ Archived {moved} posts older than {app.config['ARCHIVE_AFTER_DAYS']} days "
+              f"into {app.config['ARCHIVE_FOLDER']}/")
+        sys.exit(0)
+    
+    if args.command == 'backup':
+        create_app()
+        destination = args.path or os.path.join('backups', datetime.now().strftime('%Y%m%d-%H%M%S'))
+        report = backup_database(destination)
+        print(f"💾 Backed up {report['files']} database files ({report['bytes']:,} bytes) to {destination}/")
+        sys.exit(0)
+    
+    if args.command == 'export':
+        create_app()
+        destination = args.path or f"export-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        counts = export_ndjson(destination)
+        print(f"📤 Exported to {destination}/: " + ', '.join(f'{count} {table}' for table, count in counts.items()))
+        sys.exit(0)
+    
+    if args.command == 'import':
+        if not args.path:
+            sys.exit('import needs --path pointing at an export directory')
+        create_app()
+        counts = import_ndjson(args.path)
+        print(f"📥 Imported from {args.path}/: " + ', '.join(f'{count} {table}' for table, count in counts.items()))
+        sys.exit(0)
     
+    if args.command == 'gc-uploads':
+        create_app()
+        print(f"🧹 Removed {gc_upload_sessions()} abandoned upload sessions")
+        sys.exit(0)
+    
+    if args.command == 'purge-deleted':
+        create_app()
+        print(f"🗑️ Purged {purge_deleted_content()} deleted rows")
+        swept = collect_media_garbage() or {'blobs': 0, 'files': 0, 'bytes': 0}
+        print(f"   Swept {swept['blobs']} media blobs and {swept['files']} files ({swept['bytes']:,} bytes)")
+        print(f"   Released {incremental_vacuum()} free database pages")
+        sys.exit(0)
+    
+    if args.command == 'vacuum':
+        create_app()
+        print(f"🧽 Vacuumed {app.config['DATABASE']} ({vacuum_database():,} bytes, incremental auto-vacuum on)")
+        sys.exit(0)
+    
+    if args.command == 'bench-feed':
+        report = benchmark_feed(args.posts, args.iterations)
+        print(f"⏱️ Feed page latency over {report['posts']:,} posts / {report['likes']:,} likes")
+        for ordering, result in report['results'].items():
+            print(f"   {ordering:<7} median {result['median_ms']:.3f} ms   p95 {result['p95_ms']:.3f} ms")
+        sys.exit(0)
+    
+    if args.command == 'bench-rows':
+        report = benchmark_row_memory(args.posts)
+        print(f"🧮 Memory per row for a {report['posts']:,}-post export")
+        for kind, size in report['bytes_per_row'].items():
+            print(f"   {kind:<6} {size:,.0f} bytes")
+        sys.exit(0)
+    
+    if args.command == 'bench-sessions':
+        results = benchmark_session_bytes()
+        print("🍪 Session bytes on the wire")
+        for name, result in results.items():
+            print(f"   {name:<6} {result['bytes_per_request']:6.1f} bytes/request   "
+                  f"Set-Cookie on {result['set_cookie_responses']}/{result['requests']} responses")
+        sys.exit(0)
+    
+    if args.command == 'serve':
+        run_server(args.host, args.port, args.workers, args.threads, args.graceful_timeout)
+        sys.exit(0)
+
+    create_app()
+
     print("🚀 Starting InstaClone - Instagram-like Social Media App")
     print("=" * 50)
     print("✨ Features:")
@@ -1091,4 +4556,5 @@ if __name__ == '__main__':
     print("🌐 Server starting at: http://127.0.0.1:5000")
     print("=" * 50)
     
+    signal.signal(signal.SIGUSR1, profiler.dump)
     app.run(debug=True, host='127.0.0.1', port=5000)
\ No newline at end of file
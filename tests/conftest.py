@@ -0,0 +1,41 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instacloneb1  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = instacloneb1.create_app({
+        'DATABASE': str(tmp_path / 'instagram_clone.db'),
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'ARCHIVE_FOLDER': str(tmp_path / 'archive'),
+        'TESTING': True,
+    })
+    for limiter in instacloneb1.rate_limiters.values():
+        limiter._buckets.clear()
+    yield app
+    for limiter in instacloneb1.rate_limiters.values():
+        limiter._buckets.clear()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'demo_user', 'password': 'demo123'})
+    return client
+
+
+@pytest.fixture
+def post_id(app):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), 'red').save(buffer, 'PNG')
+    user = instacloneb1.get_user_by_username('photographer')
+    instacloneb1.create_post(user.id, [buffer.getvalue()], 'test post')
+    return instacloneb1.get_posts_for_feed(1)[0].id
@@ -0,0 +1,64 @@
+from instacloneb1 import (
+    RATE_LIMITS, PooledWSGIServer, archive_old_posts, compute_post_score, delete_account, get_db_connection,
+    get_user_by_username, purge_deleted_content, trending,
+)
+
+
+def test_batch_cannot_exceed_single_route_like_limit(client, post_id):
+    burst = RATE_LIMITS['like_post']['user'][1]
+    operations = [{'op': 'like' if i % 2 == 0 else 'unlike', 'post_id': post_id} for i in range(burst)]
+    assert client.post('/api/batch', json={'operations': operations}).status_code == 200
+
+    # The like bucket is spent, whichever route asks next
+    response = client.post('/api/batch', json={'operations': operations[:1]})
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+    assert client.post(f'/like/{post_id}').status_code == 429
+
+
+def test_batch_larger_than_like_burst_is_rejected(client, post_id):
+    burst = RATE_LIMITS['like_post']['user'][1]
+    operations = [{'op': 'like', 'post_id': post_id}] * (burst + 1)
+    assert client.post('/api/batch', json={'operations': operations}).status_code == 400
+    assert client.post(f'/like/{post_id}').status_code == 200
+
+
+def test_drain_persists_trending_events(app, post_id):
+    server = PooledWSGIServer('127.0.0.1', 0, app, threads=1)
+    trending.reset_after_fork()  # start from a clean in-memory window
+    trending.record('like', post_id, '#drained')
+    server.drain()
+
+    conn = get_db_connection()
+    rows = conn.execute("SELECT sketch FROM trending_snapshots WHERE owner = ? AND kind = 'tag'",
+                        (trending.owner,)).fetchall()
+    conn.close()
+    assert rows
+
+    # A fresh process sees the drained worker's events through the snapshots
+    trending.reset_after_fork()
+    assert ('drained', 1) in trending.top('tag')
+
+
+def test_new_post_score_matches_recompute(app, post_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    stored = c.execute('SELECT rank_score FROM posts WHERE id = ?', (post_id,)).fetchone()[0]
+    assert stored == compute_post_score(c, post_id, float(app.config['RANK_HALF_LIFE_HOURS']))
+    conn.close()
+
+
+def test_purging_archived_posts_releases_media_references(app, post_id):
+    conn = get_db_connection()
+    conn.execute("UPDATE posts SET created_at = datetime('now', '-400 days') WHERE id = ?", (post_id,))
+    conn.commit()
+    conn.close()
+    assert archive_old_posts() == 1
+
+    delete_account(get_user_by_username('photographer').id)
+    purge_deleted_content()
+
+    conn = get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('photographer',)).fetchone()[0] == 0
+    assert conn.execute('SELECT SUM(ref_count) FROM media_blobs').fetchone()[0] == 0
+    conn.close()